@@ -4,11 +4,14 @@ import model_helper
 import model_types
 import model_video
 import model_social
+import model_trace
+import model_cassette
 import os
 from firebase_functions import https_fn, scheduler_fn
 from firebase_admin import firestore
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 # GET FUTURE EARNINGS DATES
 def get_earnings() -> list:
@@ -29,7 +32,8 @@ def get_earnings() -> list:
 
     # Error logging
     if not success:
-        model_helper.log(f"EARNING API CALL FAILED: {response}")
+        model_helper.log(f"EARNING API CALL FAILED: {response}", level="error")
+        return []
     
     # Process response
     res_obj = response["earningsCalendar"]
@@ -68,7 +72,8 @@ def get_future_ipos() -> list:
 
     # Error logging
     if not success:
-        model_helper.log(f"IPO API CALL FAILED: {response}")
+        model_helper.log(f"IPO API CALL FAILED: {response}", level="error")
+        return []
     
     # Process response
     res_obj = response["ipoCalendar"]
@@ -87,44 +92,54 @@ def get_future_ipos() -> list:
     return ipos
 
 # ANALYZE AND CHOOSE WHICH ORDERS TO PLACE
-def formulate_orders() -> list:
+def formulate_orders(candidate_limit: int = 15) -> list:
 
     # Sorts response
     def sort_orders(order: model_types.Order):
         return order.execute_time, order.price
 
     # Gets data
-    ids, active_orders = model_helper.get_database_collection(
-        collection="actions",
-        field="status",
-        operator="==",
-        value="scheduled",
-        key="symbol"
-    )
+    active_orders = {
+        doc["symbol"] for id, doc in model_helper.stream_database_collection(
+            collection="actions",
+            field="status",
+            operator="==",
+            value="scheduled",
+            fields=["symbol"]
+        )
+    }
     ipos = get_future_ipos()
     limit = 50
     ipos = ipos[:limit] if len(ipos) > limit else ipos
     earnings = get_earnings()
     earnings = earnings[:limit] if len(earnings) > limit else earnings
 
-    # Creates orders
+    # Creates lazy orders (no lookups until accessed)
     orders = []
     for ipo in ipos:
         if ipo.symbol not in active_orders:
-            order = model_types.Order(
-                symbol=ipo.symbol,
-                object=ipo
+            orders.append(
+                model_types.Order(
+                    symbol=ipo.symbol,
+                    object=ipo,
+                    lazy=True
+                )
             )
-            if order.elgible:
-                orders.append(order)
     for earning in earnings:
         if earning.symbol not in active_orders:
-            order = model_types.Order(
-                symbol=earning.symbol,
-                object=earning
+            orders.append(
+                model_types.Order(
+                    symbol=earning.symbol,
+                    object=earning,
+                    lazy=True
+                )
             )
-            if order.elgible:
-                orders.append(order)
+
+    # Ranks and caps on calendar fields before enriching
+    orders.sort(key=lambda order: order.getRankKey())
+    orders = orders[:candidate_limit]
+    model_types.enrich_orders(orders)
+    orders = [order for order in orders if order.elgible]
 
     # Process orders
     orders.sort(key=sort_orders)
@@ -132,6 +147,7 @@ def formulate_orders() -> list:
 
 # CREATE ALPACA ORDER WHEN TASK QUEUED
 @https_fn.on_request()
+@model_trace.instrumented("createstockorder")
 def createstockorder(req: https_fn.Request) -> https_fn.Response:
 
     # Gets request data
@@ -155,7 +171,7 @@ def createstockorder(req: https_fn.Request) -> https_fn.Response:
             market=True
         )
         if not success or "dailyBar" not in stock_price:
-            model_helper.log(f"FAILED TO GET STOCK PRICE: {stock_price}")
+            model_helper.log(f"FAILED TO GET STOCK PRICE: {stock_price}", level="error")
             return https_fn.Response(f"FAILED TO GET STOCK PRICE: {stock_price}", status=400)
         else:
             curr_stock_price = float(stock_price["dailyBar"]["vw"])
@@ -182,7 +198,7 @@ def createstockorder(req: https_fn.Request) -> https_fn.Response:
 
             # Error Logging
             if not success:
-                model_helper.log(f"STOCK ORDER FAILED: {stock_order_res}")
+                model_helper.log(f"STOCK ORDER FAILED: {stock_order_res}", level="error")
                 return https_fn.Response(f"STOCK ORDER FAILED: {stock_order_res}", status=400)
 
             # Updates firestore document
@@ -206,121 +222,260 @@ def createstockorder(req: https_fn.Request) -> https_fn.Response:
             )
             return https_fn.Response("STOCK ORDER SUCCEEDED", status=200)
     else:
-        model_helper.log(f"INVALID API KEY")
+        model_helper.log(f"INVALID API KEY", level="error")
         return https_fn.Response(f"INVALID API KEY", status=400)
 
+# RECONCILIATION CONSTANTS
+ORDERS_PAGE_LIMIT = 500
+RECONCILE_WORKERS = 4
+RECONCILE_LOOKBACK_DAYS = 30
+UNFILLED_STATUSES = ("canceled", "expired", "rejected") # closed without the buy ever filling
+
+# PARSES ALPACA TIMESTAMP
+def parse_alpaca_time(timestamp: str) -> datetime:
+    return datetime.strptime(
+        timestamp[:-4], 
+        "%Y-%m-%dT%H:%M:%S.%f"
+    )
+
+# LISTS CLOSED ALPACA ORDERS SUBMITTED AFTER CHECKPOINT
+def get_closed_orders(after: str) -> tuple[bool, list]:
+    closed_orders = []
+    while True:
+        success, page = model_helper.get_data_alpaca(
+            url=f"v2/orders?status=closed&nested=true&direction=asc&limit={ORDERS_PAGE_LIMIT}&after={after}"
+        )
+        if not success:
+            model_helper.log(f"FAILED TO LIST ORDERS: {page}", level="error")
+            return False, closed_orders
+        closed_orders.extend(page)
+        if len(page) < ORDERS_PAGE_LIMIT:
+            return True, closed_orders
+        after = page[-1]["submitted_at"]
+
+# RECORDS FILLED LEGS OF AN EXECUTED ORDER, RETURNS TRUE WHEN COMPLETE
+def reconcile_order(id: str, order: dict, order_info: dict, buffer: model_helper.WriteBuffer) -> bool:
+
+    # Closes out brackets whose buy never filled (nothing to sell)
+    if order_info["filled_avg_price"] is None:
+        if order_info["status"] not in UNFILLED_STATUSES:
+            return False
+        buffer.set(
+            collection="actions",
+            document=id,
+            data={
+                "status": f"closed_{order_info['status']}"
+            }
+        )
+        return True
+
+    # Gets legs of order
+    complete = False
+    buy_fill_price, buy_quantity = float(order_info["filled_avg_price"]), float(order_info["filled_qty"])
+    symbol = order_info["symbol"]
+    legs = order_info["legs"]
+    buy_time = parse_alpaca_time(order_info["created_at"])
+    for order_leg in legs:
+        if order_leg["status"] == "filled":
+
+            # Calculates profit or loss on trade
+            sell_fill_price, sell_quantity = float(order_leg["filled_avg_price"]), float(order_leg["filled_qty"])
+            pl_abs = (sell_fill_price * sell_quantity) - (buy_fill_price * buy_quantity)
+            pl_rel = (pl_abs / (buy_fill_price * buy_quantity)) * 100
+            sell_time = parse_alpaca_time(order_leg["updated_at"])
+
+            # Posts tweet
+            if pl_rel > 0:
+                tweet_content = f"I just sold the {symbol} stock I bought on {buy_time} for a percent gain of {round(pl_rel, 2)}%. Do you guys approve of this?"
+            else:
+                tweet_content = f"I just sold the {symbol} stock I bought on {buy_time} for a percent loss of {round(pl_rel, 2)}%. Do you guys approve of this?"
+            success, tweet_id = model_helper.create_tweet(
+                payload={
+                    "text": tweet_content,
+                    "poll": {
+                        "options": ["Yeah, Absolutely.", "You should've held.", "I'm not sure."],
+                        "duration_minutes": 60 * 24 * 7
+                    }
+                }
+            )
+
+            # Updates database
+            order["execution_info"] = {
+                "buy_fill_price": buy_fill_price,
+                "buy_quantity": buy_quantity,
+                "sell_fill_price": sell_fill_price,
+                "sell_quantity": sell_quantity,
+                "pl_abs": pl_abs,
+                "pl_rel": pl_rel,
+                "timestamp": sell_time
+            }
+            buffer.set(
+                collection="actions",
+                document=id,
+                data={
+                    "status": "complete",
+                    "associated_action": order,
+                    "associated_tweet_followup_id": tweet_id if success else "failed"
+                }
+            )
+            complete = True
+    return complete
+
 # CHECK ORDER STATUS
 @scheduler_fn.on_schedule(schedule="0 * * * *")
+@model_trace.instrumented("check_orders")
 def check_orders(req: https_fn.Request) -> https_fn.Response:
+    run_check_orders()
+
+# RECONCILES EXECUTED ORDERS, RETURNS NUMBER COMPLETED
+def run_check_orders() -> int:
 
-    # Gets executed orders
-    ids, executed_orders = model_helper.get_database_collection(
+    # Loads executed orders keyed by alpaca order id
+    run_started = model_cassette.now(timezone.utc).replace(tzinfo=None)
+    executed_orders = {}
+    for id, doc in model_helper.stream_database_collection(
         collection="actions",
         field="status",
         operator="==",
         value="executed",
-        key="associated_action"
+        fields=["associated_action"],
+        order_by="execute_time"
+    ):
+        order = doc["associated_action"]
+        executed_orders[order["alpaca_order_id"]] = (id, order)
+    if len(executed_orders) == 0:
+        return 0
+
+    # Pulls closed orders since checkpoint (falls back to one request per order)
+    checkpoint = model_helper.get_database(
+        collection="state",
+        document="check_orders"
     )
-
-    for id, order in zip(ids, executed_orders):
-        
-        # Gets order info
-        alpaca_order_id = order['alpaca_order_id']
-        success, order_info = model_helper.get_data_alpaca(
-            url=f"v2/orders/{alpaca_order_id}?nested=true"
-        )
-        if success:
-
-            # Gets legs of order
-            buy_fill_price, buy_quantity = float(order_info["filled_avg_price"]), float(order_info["filled_qty"])
-            symbol = order_info["symbol"]
-            legs = order_info["legs"]
-            buy_time = datetime.strptime(
-                order_info["created_at"][:-4], 
-                "%Y-%m-%dT%H:%M:%S.%f"
+    default_after = run_started - timedelta(days=RECONCILE_LOOKBACK_DAYS)
+    after = checkpoint["after"] if checkpoint else default_after.strftime("%Y-%m-%dT%H:%M:%SZ")
+    success, closed_orders = get_closed_orders(after=after)
+    if not success:
+        closed_orders = []
+        for alpaca_order_id in executed_orders:
+            success, order_info = model_helper.get_data_alpaca(
+                url=f"v2/orders/{alpaca_order_id}?nested=true"
             )
-            for order_leg in legs:
-                if order_leg["status"] == "filled":
-
-                    # Calculates profit or loss on trade
-                    sell_fill_price, sell_quantity = float(order_leg["filled_avg_price"]), float(order_leg["filled_qty"])
-                    pl_abs = (sell_fill_price * sell_quantity) - (buy_fill_price * buy_quantity)
-                    pl_rel = (pl_abs / (buy_fill_price * buy_quantity)) * 100
-                    sell_time = datetime.strptime(
-                        order_leg["updated_at"][:-4], 
-                        "%Y-%m-%dT%H:%M:%S.%f"
-                    )
-
-                    # Posts tweet
-                    if pl_rel > 0:
-                        tweet_content = f"I just sold the {symbol} stock I bought on {buy_time} for a percent gain of {round(pl_rel, 2)}%. Do you guys approve of this?"
-                    else:
-                        tweet_content = f"I just sold the {symbol} stock I bought on {buy_time} for a percent loss of {round(pl_rel, 2)}%. Do you guys approve of this?"
-                    success, tweet_id = model_helper.create_tweet(
-                        payload={
-                            "text": tweet_content,
-                            "poll": {
-                                "options": ["Yeah, Absolutely.", "You should've held.", "I'm not sure."],
-                                "duration_minutes": 60 * 24 * 7
-                            }
-                        }
-                    )
-
-                    # Updates database
-                    order["execution_info"] = {
-                        "buy_fill_price": buy_fill_price,
-                        "buy_quantity": buy_quantity,
-                        "sell_fill_price": sell_fill_price,
-                        "sell_quantity": sell_quantity,
-                        "pl_abs": pl_abs,
-                        "pl_rel": pl_rel,
-                        "timestamp": sell_time
-                    }
-                    model_helper.set_database(
-                        collection="actions",
-                        document=id,
-                        data={
-                            "status": "complete",
-                            "associated_action": order,
-                            "associated_tweet_followup_id": tweet_id if success else "failed"
-                        }
-                    )
-    
+            if success:
+                closed_orders.append(order_info)
+    matches = [
+        (*executed_orders[order_info["id"]], order_info) 
+        for order_info in closed_orders if order_info["id"] in executed_orders
+    ]
+
+    # Reconciles matches in parallel and commits writes together (one bad order never blocks the rest)
+    buffer = model_helper.WriteBuffer()
+    def reconcile_match(match: tuple) -> bool:
+        try:
+            return reconcile_order(*match, buffer=buffer)
+        except Exception as error:
+            model_helper.log(f"RECONCILE ORDER FAILED: {match[0]} {error}", level="error")
+            return False
+    with ThreadPoolExecutor(max_workers=RECONCILE_WORKERS) as executor:
+        completed = list(executor.map(model_trace.propagate(reconcile_match), matches))
+    buffer.flush()
+
+    # Moves checkpoint to the oldest order still open
+    submitted = {order_info["id"]: parse_alpaca_time(order_info["submitted_at"]) for order_info in closed_orders}
+    completed_ids = {match[2]["id"] for match, complete in zip(matches, completed) if complete}
+    unfilled_ids = {
+        order_info["id"] for order_info in closed_orders
+        if order_info["filled_avg_price"] is None and order_info["status"] in UNFILLED_STATUSES
+    }
+    open_times = []
+    for alpaca_order_id, (id, order) in executed_orders.items():
+        if alpaca_order_id in completed_ids or alpaca_order_id in unfilled_ids:
+            continue
+        if alpaca_order_id in submitted:
+            open_times.append(submitted[alpaca_order_id])
+        elif isinstance(order.get("timestamp"), datetime):
+            open_times.append(order["timestamp"].astimezone(timezone.utc).replace(tzinfo=None))
+        else:
+            open_times.append(default_after)
+    next_after = min(open_times + [run_started]) - timedelta(minutes=1)
+    model_helper.set_database(
+        collection="state",
+        document="check_orders",
+        data={
+            "after": next_after.strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
+    )
+    return len(completed_ids)
+
+# ANALYZES A BATCH OF ORDERS AND SCHEDULES THOSE WITH A FREE EXECUTION SLOT
+def execute_orders(batch: list, slots: model_types.ExecutionSlots, deadline: float):
+    if slots.full or time.monotonic() > deadline:
+        return
+    try:
+        with model_trace.span("analysis", symbols=[order.symbol for order in batch]):
+            model_types.analyze_orders(orders=batch)
+    except Exception as error:
+        model_helper.log(f"SCHEDULE ORDERS ERROR: {error}", level="error")
+        return
+
+    # Post-schedule writes for the batch are coalesced and committed together (one span per order)
+    with model_helper.WriteBuffer() as buffer:
+        for order in batch:
+            with model_trace.span("order", symbol=order.symbol, order_id=order.id) as span:
+                try:
+                    if order.elgible:
+                        if slots.reserve():
+                            try:
+                                # Committed before queueing so createstockorder always finds the action
+                                order.updateDatabase()
+                                order.scheduleTask()
+                            finally:
+                                if order.status == "scheduled":
+                                    slots.commit()
+                                else:
+                                    slots.release()
+                            order.postTweet()
+                        else:
+                            order.status = "canceled_exec_limit"
+                    order.updateDatabase(buffer=buffer)
+                    span.set(status=order.status)
+                    model_helper.log(str(order))
+                except Exception as error:
+                    span.set(error=repr(error))
+                    model_helper.log(f"SCHEDULE ORDERS ERROR: {error}", level="error")
+
 # CREATE TASK QUEUE ORDER AND FIRESTORE ENTRY
 @scheduler_fn.on_schedule(schedule="0 4 * * *", timeout_sec=300)
+@model_trace.instrumented("schedule_orders")
 def schedule_orders(req: https_fn.Request) -> https_fn.Response:
+    run_schedule_orders()
+
+# FORMULATES, ANALYZES AND SCHEDULES ORDERS, RETURNS THE CANDIDATES
+def run_schedule_orders() -> list:
 
     # Creates orders after retrieving data
     orders_exec_limit = 5
-    orders_exec = 0
-    orders = formulate_orders()
-
-    # Get additional info about orders and schedules them
-    for order in orders:
-
-        # Analyzes stock via AI
-        if orders_exec < orders_exec_limit:
-            try:
-                order.analyzeAI()
-                order.updateDatabase()
-                if order.elgible:
-                    order.scheduleTask()
-                    order.postTweet()
-                    if order.status == "scheduled":
-                        orders_exec += 1
-                time.sleep(1)
-                order.updateDatabase()
-                model_helper.log(str(order))
-            except Exception as error:
-                model_helper.log(f"SCHEDULE ORDERS ERROR: {error}")
-                continue
-        else:
-            break
+    workers = int(os.getenv("SCHEDULE_WORKERS", 4))
+    batch_size = int(os.getenv("ANALYSIS_BATCH_SIZE", 3))
+    deadline = time.monotonic() + 240 # leaves headroom within timeout_sec
+    orders = formulate_orders(candidate_limit=orders_exec_limit * (3 if workers == 1 else 6))
+
+    # Analyzes batches and schedules orders concurrently (provider limits live in model_helper)
+    slots = model_types.ExecutionSlots(limit=orders_exec_limit)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(model_trace.propagate(execute_orders), orders[i:i+batch_size], slots, deadline)
+            for i in range(0, len(orders), batch_size)
+        ]
+    for future in futures:
+        if future.exception() is not None:
+            model_helper.log(f"SCHEDULE ORDERS ERROR: {future.exception()}", level="error")
+    return orders
 
 # check_orders()
 
 # CREATES VIDEO AND UPLOADS TO YOUTUBE
 @https_fn.on_request()
+@model_trace.instrumented("create_video")
 def create_video(req: https_fn.Request) -> https_fn.Response:
     try:
 
@@ -341,15 +496,19 @@ def create_video(req: https_fn.Request) -> https_fn.Response:
             filename = model_video.create_video_beta(
                 text=text
             )
-            success, youtube_id = model_social.upload_video(
-                filename=filename,
-                type=vid_type,
-                title=title,
-                description=description,
-                tags=tags,
-                category_id=category_id,
-                privacy_status=status
-            )
+            try:
+                success, youtube_id = model_social.upload_video(
+                    filename=filename,
+                    type=vid_type,
+                    title=title,
+                    description=description,
+                    tags=tags,
+                    category_id=category_id,
+                    privacy_status=status
+                )
+            finally:
+                if filename and os.path.exists(filename):
+                    os.remove(filename)
 
             # Updates database
             if success:
@@ -371,5 +530,5 @@ def create_video(req: https_fn.Request) -> https_fn.Response:
     except Exception as error:
 
         # Prints error log
-        model_helper.log(f"ERROR WITH VIDEO CREATION: {error}")
+        model_helper.log(f"ERROR WITH VIDEO CREATION: {error}", level="error")
         return https_fn.Response(f"ERROR WITH VIDEO CREATION: {error}", status=400)
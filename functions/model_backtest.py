@@ -0,0 +1,319 @@
+
+# DEPENDENCIES
+import argparse
+import json
+import os
+import sys
+import numpy as np
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import model_market
+
+# BACKTEST CONSTANTS
+HORIZON_BARS = 390 # one trading day of minute bars
+ENTRY_MAX_GAP_MINUTES = 30 # entry bars later than this after the execute time are treated as missing data
+PERCENTILES = [5, 25, 50, 75, 95]
+EXIT_TAKE_PROFIT = 0
+EXIT_STOP_LOSS = 1
+EXIT_HORIZON = 2
+
+# SWEEP CONSTANTS
+SWEEP_CHUNK_SIZE = 32 # grid points per worker task
+SWEEP_MIN_TRADES = 20 # stances with fewer trades keep their current bracket
+SWEEP_GRID = {
+    "upper": "1.01:1.2:20",
+    "lower": "0.8:0.99:20",
+    "safety": "0.005:0.05:4"
+}
+
+# BRACKET MULTIPLIERS PER STANCE (shared with model_types)
+BRACKET_CONFIG = os.getenv("BRACKET_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bracket_config.json"))
+with open(BRACKET_CONFIG) as bracket_file:
+    STANCE_BRACKETS = json.load(bracket_file)
+
+# CALENDAR HOUR TO BUY TIME OFFSET (mirrors EarningsObject and IpoObject)
+BUY_TIME_OFFSETS = {
+    "bmo": timedelta(hours=9, minutes=30),
+    "amc": timedelta(hours=33, minutes=30),
+    "dmh": timedelta(hours=14),
+    "ipo": timedelta(hours=14)
+}
+
+# LOADS EVENTS ([{symbol, date, hour, stance}], hour is bmo/amc/dmh/ipo)
+def load_events(path: str) -> list:
+    with open(path) as events_file:
+        raw_events = json.load(events_file)
+    events = []
+    for event in raw_events:
+        if event.get("hour") not in BUY_TIME_OFFSETS:
+            continue
+        buy_time = datetime.strptime(event["date"], "%Y-%m-%d") + BUY_TIME_OFFSETS[event["hour"]]
+        events.append({
+            "symbol": event["symbol"],
+            "execute_time": np.datetime64(buy_time - timedelta(minutes=5), "s"),
+            "stance": event.get("stance", "neutral")
+        })
+    return events
+
+# LOADS BARS FROM {SYMBOL}.npz FILES (t as datetime64 in exchange local time, open, high, low, close)
+def load_bars(directory: str, symbols: list) -> dict:
+    bars = {}
+    for symbol in set(symbols):
+        path = os.path.join(directory, f"{symbol}.npz")
+        if os.path.exists(path):
+            with np.load(path) as data:
+                bars[symbol] = {field: data[field] for field in ["t", "open", "high", "low", "close"]}
+                bars[symbol]["t"] = bars[symbol]["t"].astype("datetime64[s]")
+    return bars
+
+# BUILDS TRADES x HORIZON BAR WINDOWS STARTING AT EACH ENTRY BAR (dropped counts events without a usable entry)
+def build_windows(events: list, bars: dict, horizon: int = HORIZON_BARS, max_gap_minutes: int = ENTRY_MAX_GAP_MINUTES) -> dict:
+
+    # Flattens every symbol's bars into one array with offsets
+    symbols = sorted(bars)
+    lengths = np.array([len(bars[symbol]["t"]) for symbol in symbols], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    flat = {
+        field: np.concatenate([bars[symbol][field] for symbol in symbols]) if symbols else np.array([])
+        for field in ["t", "open", "high", "low", "close"]
+    }
+
+    # Finds entry bar per event (one searchsorted per symbol)
+    kept = [event for event in events if event["symbol"] in bars]
+    event_symbols = np.array([symbols.index(event["symbol"]) for event in kept], dtype=np.int64)
+    execute_times = np.array([event["execute_time"] for event in kept], dtype="datetime64[s]")
+    entries = np.zeros(len(kept), dtype=np.int64)
+    for symbol_index in np.unique(event_symbols):
+        mask = event_symbols == symbol_index
+        start, end = offsets[symbol_index], offsets[symbol_index + 1]
+        entries[mask] = start + np.searchsorted(flat["t"][start:end], execute_times[mask], side="left")
+    ends = offsets[event_symbols + 1]
+    tradable = entries < ends
+
+    # Entry must fall in the event's session and within the gap tolerance (missing days would shift trades)
+    if len(flat["t"]) > 0:
+        entry_times = flat["t"][np.minimum(entries, len(flat["t"]) - 1)]
+    else:
+        entry_times = execute_times
+    in_session = entry_times.astype("datetime64[D]") == execute_times.astype("datetime64[D]")
+    in_gap = entry_times - execute_times <= np.timedelta64(max_gap_minutes, "m")
+    dropped = {
+        "no_bars": len(events) - len(kept),
+        "no_entry": int(np.sum(~tradable)),
+        "entry_gap": int(np.sum(tradable & ~(in_session & in_gap)))
+    }
+    tradable &= in_session & in_gap
+    kept = [event for event, ok in zip(kept, tradable) if ok]
+    entries, ends = entries[tradable], ends[tradable]
+
+    # Gathers windows (bars past a symbol's data are masked)
+    index = entries[:, None] + np.arange(horizon)[None, :]
+    valid = index < ends[:, None]
+    index = np.minimum(index, (ends - 1)[:, None])
+    last = np.minimum(entries + horizon, ends) - 1
+    return {
+        "symbols": np.array([event["symbol"] for event in kept]),
+        "stances": np.array([event["stance"] for event in kept]),
+        "entry_price": flat["open"][entries] if len(entries) else np.array([]),
+        "open": flat["open"][index],
+        "high": flat["high"][index],
+        "low": flat["low"][index],
+        "valid": valid,
+        "exit_close": flat["close"][last] if len(entries) else np.array([]),
+        "dropped": dropped
+    }
+
+# SIMULATES BRACKET FILLS FOR ALL TRADES AT ONCE (upper, lower, safety broadcast against trades)
+def simulate_brackets(windows: dict, upper, lower, safety) -> dict:
+    upper, lower, safety = np.asarray(upper, dtype=float), np.asarray(lower, dtype=float), np.asarray(safety, dtype=float)
+    entry = windows["entry_price"]
+    horizon = windows["valid"].shape[-1]
+    take_profit = (entry * upper)[..., None]
+    stop = (entry * lower)[..., None]
+    stop_limit = (entry * (lower - safety))[..., None]
+
+    # First bar touching each leg (same bar touches count as a stop, conservatively)
+    hit_profit = (windows["high"] >= take_profit) & windows["valid"]
+    hit_stop = (windows["low"] <= stop) & windows["valid"]
+    first_profit = np.where(hit_profit.any(-1), hit_profit.argmax(-1), horizon)
+    first_stop = np.where(hit_stop.any(-1), hit_stop.argmax(-1), horizon)
+
+    # Fill prices (gaps fill at the open, stop limit orders gapping below their limit stay open)
+    profit_open = np.take_along_axis(np.broadcast_to(windows["open"], hit_profit.shape), np.minimum(first_profit, horizon - 1)[..., None], -1)[..., 0]
+    stop_open = np.take_along_axis(np.broadcast_to(windows["open"], hit_stop.shape), np.minimum(first_stop, horizon - 1)[..., None], -1)[..., 0]
+    profit_fill = np.maximum(take_profit[..., 0], profit_open)
+    stop_fill = np.minimum(stop[..., 0], stop_open)
+    stop_filled = (first_stop < horizon) & (first_stop <= first_profit) & (stop_fill >= stop_limit[..., 0])
+    profit_filled = (first_profit < horizon) & ~stop_filled & ((first_profit < first_stop) | (stop_fill < stop_limit[..., 0]))
+
+    # Exit prices and reasons
+    exit_price = np.where(stop_filled, stop_fill, np.where(profit_filled, profit_fill, windows["exit_close"]))
+    exit_reason = np.where(stop_filled, EXIT_STOP_LOSS, np.where(profit_filled, EXIT_TAKE_PROFIT, EXIT_HORIZON))
+    return {
+        "returns": (exit_price - entry) / entry * 100,
+        "exit_reason": exit_reason
+    }
+
+# SUMMARIZES A RETURN DISTRIBUTION (percent per trade)
+def summarize(returns: np.ndarray, exit_reason: np.ndarray) -> dict:
+    if len(returns) == 0:
+        return {"trades": 0}
+    return {
+        "trades": int(len(returns)),
+        "mean": float(np.mean(returns)),
+        "std": float(np.std(returns)),
+        "total": float(np.sum(returns)),
+        "win_rate": float(np.mean(returns > 0)),
+        "percentiles": {str(p): float(v) for p, v in zip(PERCENTILES, np.percentile(returns, PERCENTILES))},
+        "take_profit_rate": float(np.mean(exit_reason == EXIT_TAKE_PROFIT)),
+        "stop_loss_rate": float(np.mean(exit_reason == EXIT_STOP_LOSS))
+    }
+
+# RUNS BACKTEST WITH EACH TRADE'S STANCE BRACKET
+def run_backtest(
+    events: list, 
+    bars: dict, 
+    horizon: int = HORIZON_BARS, 
+    brackets: dict = STANCE_BRACKETS, 
+    max_gap_minutes: int = ENTRY_MAX_GAP_MINUTES
+) -> dict:
+    windows = build_windows(events=events, bars=bars, horizon=horizon, max_gap_minutes=max_gap_minutes)
+    stances = np.where(np.isin(windows["stances"], list(brackets)), windows["stances"], "neutral")
+    result = simulate_brackets(
+        windows=windows,
+        upper=np.array([brackets[stance]["upper"] for stance in stances]),
+        lower=np.array([brackets[stance]["lower"] for stance in stances]),
+        safety=np.array([brackets[stance]["safety"] for stance in stances])
+    )
+    report = {"all": summarize(result["returns"], result["exit_reason"]), "dropped": windows["dropped"]}
+    for stance in brackets:
+        mask = stances == stance
+        report[stance] = summarize(result["returns"][mask], result["exit_reason"][mask])
+    return report
+
+# PARSES start:stop:num INTO GRID VALUES
+def parse_range(spec: str) -> np.ndarray:
+    start, stop, num = spec.split(":")
+    return np.linspace(float(start), float(stop), int(num))
+
+# SELECTS TRADES FOR ONE STANCE FROM WINDOWS
+def select_windows(windows: dict, mask: np.ndarray) -> dict:
+    return {field: values[mask] for field, values in windows.items() if field != "dropped"}
+
+# WORKER STATE (windows per stance, set once per process)
+SWEEP_WINDOWS = {}
+
+def init_sweep_worker(windows_by_stance: dict):
+    SWEEP_WINDOWS.update(windows_by_stance)
+
+# EVALUATES A CHUNK OF GRID POINTS FOR ONE STANCE (params x trades in one simulation)
+def evaluate_grid(stance: str, params: np.ndarray) -> dict:
+    windows = SWEEP_WINDOWS[stance]
+    result = simulate_brackets(
+        windows=windows,
+        upper=params[:, 0:1],
+        lower=params[:, 1:2],
+        safety=params[:, 2:3]
+    )
+    returns = result["returns"]
+    percentiles = np.percentile(returns, PERCENTILES, axis=1)
+    return {
+        "stance": np.full(len(params), stance),
+        "upper": params[:, 0],
+        "lower": params[:, 1],
+        "safety": params[:, 2],
+        "trades": np.full(len(params), returns.shape[1]),
+        "mean": returns.mean(axis=1),
+        "std": returns.std(axis=1),
+        "total": returns.sum(axis=1),
+        "win_rate": (returns > 0).mean(axis=1),
+        **{f"p{p}": values for p, values in zip(PERCENTILES, percentiles)}
+    }
+
+# SWEEPS BRACKET GRID PER STANCE ACROSS A PROCESS POOL, RETURNS COLUMNS RANKED BY MEAN RETURN
+def sweep(
+    events: list, 
+    bars: dict, 
+    grid: dict, 
+    horizon: int = HORIZON_BARS, 
+    workers: int | None = None, 
+    max_gap_minutes: int = ENTRY_MAX_GAP_MINUTES
+) -> dict:
+
+    # Splits trades by stance
+    windows = build_windows(events=events, bars=bars, horizon=horizon, max_gap_minutes=max_gap_minutes)
+    print(f"DROPPED EVENTS: {json.dumps(windows['dropped'])}", file=sys.stderr)
+    windows_by_stance = {
+        stance: select_windows(windows, windows["stances"] == stance) 
+        for stance in STANCE_BRACKETS if np.any(windows["stances"] == stance)
+    }
+
+    # Builds (upper, lower, safety) grid, skipping brackets whose stop limit would be above the stop
+    mesh = np.stack(np.meshgrid(grid["upper"], grid["lower"], grid["safety"], indexing="ij"), axis=-1).reshape(-1, 3)
+    mesh = mesh[mesh[:, 1] - mesh[:, 2] > 0]
+    tasks = [
+        (stance, mesh[i:i+SWEEP_CHUNK_SIZE]) 
+        for stance in windows_by_stance for i in range(0, len(mesh), SWEEP_CHUNK_SIZE)
+    ]
+
+    # Fans chunks out across processes
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_sweep_worker, initargs=(windows_by_stance,)) as executor:
+        chunks = list(executor.map(evaluate_grid, *zip(*tasks))) if tasks else []
+    if len(chunks) == 0:
+        return {}
+
+    # Ranks by stance then mean return
+    columns = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in chunks[0]}
+    order = np.lexsort((-columns["mean"], columns["stance"]))
+    return {field: values[order] for field, values in columns.items()}
+
+# PICKS BEST BRACKET PER STANCE FROM RANKED SWEEP COLUMNS
+def best_brackets(columns: dict, min_trades: int = SWEEP_MIN_TRADES) -> dict:
+    brackets = {stance: dict(bracket) for stance, bracket in STANCE_BRACKETS.items()}
+    for stance in brackets:
+        rows = np.flatnonzero((columns.get("stance", np.array([])) == stance) & (columns.get("trades", np.array([])) >= min_trades))
+        if len(rows) > 0:
+            brackets[stance] = {field: round(float(columns[field][rows[0]]), 4) for field in ["upper", "lower", "safety"]}
+    return brackets
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtests the earnings/ipo bracket strategy on local bars.")
+    parser.add_argument("mode", choices=["backtest", "sweep"])
+    parser.add_argument("events", help="events json file")
+    parser.add_argument("bars", nargs="?", help="directory of {SYMBOL}.npz bar files (omit with --store)")
+    parser.add_argument("--store", action="store_true", help="read bars from the local market data store")
+    parser.add_argument("--timeframe", default="1Min", help="market data store timeframe")
+    parser.add_argument("--horizon", type=int, default=HORIZON_BARS, help="bars held before exiting at close")
+    parser.add_argument("--max-gap", type=int, default=ENTRY_MAX_GAP_MINUTES, help="minutes an entry bar may trail the execute time")
+    parser.add_argument("--upper", default=SWEEP_GRID["upper"], help="take profit multipliers as start:stop:num")
+    parser.add_argument("--lower", default=SWEEP_GRID["lower"], help="stop multipliers as start:stop:num")
+    parser.add_argument("--safety", default=SWEEP_GRID["safety"], help="stop limit offsets as start:stop:num")
+    parser.add_argument("--workers", type=int, default=None, help="sweep processes (defaults to cpu count)")
+    parser.add_argument("--output", default="sweep_results.npz", help="ranked sweep results (columnar npz)")
+    parser.add_argument("--write-config", action="store_true", help="write best brackets to the bracket config")
+    args = parser.parse_args()
+    events = load_events(path=args.events)
+    symbols = [event["symbol"] for event in events]
+    if args.store:
+        bars = model_market.load_backtest_bars(symbols=symbols, timeframe=args.timeframe)
+    else:
+        bars = load_bars(directory=args.bars, symbols=symbols)
+
+    match args.mode:
+        case "backtest":
+            print(json.dumps(run_backtest(events=events, bars=bars, horizon=args.horizon, max_gap_minutes=args.max_gap), indent=2))
+        case "sweep":
+            columns = sweep(
+                events=events,
+                bars=bars,
+                grid={field: parse_range(getattr(args, field)) for field in ["upper", "lower", "safety"]},
+                horizon=args.horizon,
+                workers=args.workers,
+                max_gap_minutes=args.max_gap
+            )
+            np.savez_compressed(args.output, **columns)
+            brackets = best_brackets(columns=columns)
+            print(json.dumps(brackets, indent=2))
+            if args.write_config:
+                with open(BRACKET_CONFIG, "w") as bracket_file:
+                    json.dump(brackets, bracket_file, indent=2)
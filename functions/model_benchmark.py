@@ -0,0 +1,234 @@
+
+# DEPENDENCIES
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+# BENCHMARK CONSTANTS
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_BASELINE = os.path.join(BENCHMARK_DIR, "benchmark_baseline.json")
+BENCHMARK_OUTPUT = "/tmp/benchmark_results.json"
+BENCHMARK_TOLERANCE = 0.15 # allowed relative change before a metric counts as regressed
+BENCHMARK_SCRIPT = (
+    "Fred likes stonks. Today the market opened higher after a strong jobs report. "
+    "Chip makers led the rally while energy stocks slipped as oil prices fell. "
+    "Investors are watching earnings from the biggest retailers later this week. "
+    "Remember, this is not financial advice, Fred just likes stonks."
+)
+BENCHMARK_METRICS = { # metric: True when higher is better
+    "formulate_orders.seconds_per_candidate": False,
+    "schedule_orders.seconds_per_candidate": False,
+    "check_orders.orders_per_second": True,
+    "create_video_beta.frames_per_second": True,
+    "create_video_beta.peak_rss_mb": False
+}
+
+# GETS PEAK RESIDENT MEMORY OF THIS PROCESS AND ITS REAPED CHILDREN (megabytes)
+def peak_rss_mb() -> float:
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) / 1024
+
+# MEASURES FORMULATING ORDERS
+def bench_formulate_orders() -> dict:
+    import main
+    started = time.perf_counter()
+    orders = main.formulate_orders()
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": elapsed,
+        "candidates": len(orders),
+        "seconds_per_candidate": elapsed / max(len(orders), 1)
+    }
+
+# MEASURES SCHEDULING ORDERS (formulation, analysis, tasks, tweets and writes)
+def bench_schedule_orders() -> dict:
+    import main
+    started = time.perf_counter()
+    orders = main.run_schedule_orders()
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": elapsed,
+        "candidates": len(orders),
+        "seconds_per_candidate": elapsed / max(len(orders), 1)
+    }
+
+# MEASURES RECONCILING EXECUTED ORDERS
+def bench_check_orders() -> dict:
+    import main
+    started = time.perf_counter()
+    reconciled = main.run_check_orders()
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": elapsed,
+        "reconciled": reconciled,
+        "orders_per_second": reconciled / elapsed
+    }
+
+# MEASURES RENDERING THE FIXED SCRIPT
+def bench_create_video_beta() -> dict:
+    import model_video
+    from moviepy import VideoFileClip
+    started = time.perf_counter()
+    filename = model_video.create_video_beta(text=BENCHMARK_SCRIPT)
+    elapsed = time.perf_counter() - started
+    with VideoFileClip(filename) as clip:
+        duration = clip.duration
+    os.remove(filename)
+    frames = round(duration * model_video.RENDER_FPS)
+    return {
+        "seconds": elapsed,
+        "video_seconds": duration,
+        "frames": frames,
+        "frames_per_second": frames / elapsed,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+BENCHMARKS = {
+    "formulate_orders": bench_formulate_orders,
+    "schedule_orders": bench_schedule_orders,
+    "check_orders": bench_check_orders,
+    "create_video_beta": bench_create_video_beta
+}
+
+# DECODES SEED VALUES ({"$datetime": iso} becomes a timestamp)
+def decode_seed(value):
+    if isinstance(value, dict):
+        if set(value) == {"$datetime"}:
+            return datetime.fromisoformat(value["$datetime"])
+        return {name: decode_seed(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [decode_seed(item) for item in value]
+    return value
+
+# CLEARS EMULATOR AND LOADS SEED DOCUMENTS ({collection: {document: data}})
+def reset_emulator(seed_path: str | None):
+    project = os.getenv("GCLOUD_PROJECT", "demo-nous")
+    request = urllib.request.Request(
+        f"http://{os.getenv('FIRESTORE_EMULATOR_HOST')}/emulator/v1/projects/{project}/databases/(default)/documents",
+        method="DELETE"
+    )
+    urllib.request.urlopen(request).close()
+    if seed_path:
+        import model_helper
+        with open(seed_path) as seed_file:
+            seed = decode_seed(json.load(seed_file))
+        with model_helper.WriteBuffer() as buffer:
+            for collection, documents in seed.items():
+                for document, data in documents.items():
+                    buffer.set(collection=collection, document=document, data=data)
+
+# POINTS THE WORKER AT ITS OWN ENVIRONMENT (runs before model_helper is imported)
+def init_benchmark_worker(environment: dict):
+    os.environ.update(environment)
+
+# RUNS BENCHMARK IN A FRESH PROCESS (cold memory and disk caches, isolated peak memory)
+def run_isolated(name: str) -> dict:
+    cache_dir = tempfile.mkdtemp(prefix="benchmark_cache_", dir="/tmp")
+    environment = {
+        "TTS_CACHE_DIR": os.path.join(cache_dir, "tts"),
+        "PHOTO_CACHE_DIR": os.path.join(cache_dir, "photos")
+    }
+    try:
+        with ProcessPoolExecutor(
+            max_workers=1, 
+            mp_context=multiprocessing.get_context("spawn"), 
+            initializer=init_benchmark_worker, 
+            initargs=(environment,)
+        ) as executor:
+            return executor.submit(BENCHMARKS[name]).result()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+# RUNS BENCHMARKS, RETURNS MEDIAN OF EACH MEASUREMENT
+def run_benchmarks(names: list, repeat: int = 3, seed_path: str | None = None) -> dict:
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            reset_emulator(seed_path=seed_path)
+            runs.append(run_isolated(name=name))
+        results[name] = {
+            measurement: statistics.median(run[measurement] for run in runs)
+            for measurement in runs[0]
+        }
+        print(f"{name}: {json.dumps(results[name])}")
+    return results
+
+# COMPARES RESULTS TO BASELINE, RETURNS {metric: comparison}
+def compare(results: dict, baseline: dict, tolerance: float = BENCHMARK_TOLERANCE) -> dict:
+    comparison = {}
+    for metric, higher_is_better in BENCHMARK_METRICS.items():
+        name, measurement = metric.split(".")
+        value = results.get(name, {}).get(measurement)
+        reference = baseline.get(name, {}).get(measurement)
+        if value is None or not reference:
+            continue
+        change = (value - reference) / reference
+        comparison[metric] = {
+            "value": value,
+            "baseline": reference,
+            "change": change,
+            "regressed": change < -tolerance if higher_is_better else change > tolerance
+        }
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks scheduling, reconciliation and video paths offline")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", help="json of {collection: {document: data}} loaded before every run")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=BENCHMARK_TOLERANCE)
+    parser.add_argument("--output", default=BENCHMARK_OUTPUT)
+    parser.add_argument("--write-baseline", action="store_true")
+    args = parser.parse_args()
+
+    # Benchmarks write orders and tasks, so they only run against stand-ins
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("FIRESTORE_EMULATOR_HOST must point at the firestore emulator")
+    if os.getenv("TRANSPORT_MODE", "live") != "replay":
+        print("WARNING: TRANSPORT_MODE is not replay, providers are called through their base urls")
+    else:
+        import model_cassette
+        if not os.getenv("TRANSPORT_CLOCK") and not os.path.exists(model_cassette.CLOCK_FILE):
+            sys.exit(f"NO RECORDED CLOCK IN {model_cassette.CASSETTE_DIR}, date keyed requests would miss (set TRANSPORT_CLOCK)")
+
+    results = run_benchmarks(names=args.benchmarks, repeat=args.repeat, seed_path=args.seed)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    comparison = compare(results=results, baseline=baseline, tolerance=args.tolerance)
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "transport_mode": os.getenv("TRANSPORT_MODE", "live"),
+        "replay_latency_ms": os.getenv("REPLAY_LATENCY_MS", "0"),
+        "repeat": args.repeat,
+        "results": results,
+        "baseline": args.baseline if baseline else None,
+        "comparison": comparison
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    if args.write_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+
+    # Fails on regressions so they surface before deploy
+    regressions = [metric for metric, entry in comparison.items() if entry["regressed"]]
+    for metric in regressions:
+        entry = comparison[metric]
+        print(f"REGRESSION {metric}: {entry['value']:.4g} vs {entry['baseline']:.4g} ({entry['change']:+.1%})")
+    sys.exit(1 if regressions else 0)
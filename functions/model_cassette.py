@@ -0,0 +1,149 @@
+
+# DEPENDENCIES
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qsl
+
+# CASSETTE CONSTANTS
+TRANSPORT_MODE = os.getenv("TRANSPORT_MODE", "live") # live, record or replay
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cassettes"))
+REPLAY_LATENCY_MS = os.getenv("REPLAY_LATENCY_MS", "0") # fixed milliseconds or "recorded"
+SECRET_PARAMS = {"token", "apikey", "api-key", "key"}
+CLOCK_FILE = os.path.join(CASSETTE_DIR, "clock.json")
+FROZEN_TIME = None
+FROZEN_TIME_LOCK = threading.Lock()
+MISS_MESSAGE = "no cassette recorded"
+MISS_BODIES = { # unrecorded requests get each provider's own error shape
+    "finnhub": {"error": MISS_MESSAGE},
+    "news": {"status": "error", "code": "cassetteMissing", "message": MISS_MESSAGE},
+    "jokeapi": {"error": True, "message": MISS_MESSAGE},
+    "pexels": {"error": MISS_MESSAGE}
+}
+
+# GETS FROZEN WALL CLOCK (record pins the time of the first recording, replay reuses it)
+def get_frozen_time() -> datetime | None:
+    global FROZEN_TIME
+    if TRANSPORT_MODE == "live":
+        return None
+    with FROZEN_TIME_LOCK:
+        if FROZEN_TIME is None:
+            if os.getenv("TRANSPORT_CLOCK"):
+                FROZEN_TIME = datetime.fromisoformat(os.getenv("TRANSPORT_CLOCK"))
+            elif os.path.exists(CLOCK_FILE):
+                with open(CLOCK_FILE) as clock_file:
+                    FROZEN_TIME = datetime.fromisoformat(json.load(clock_file)["now"])
+            else:
+                FROZEN_TIME = datetime.now(timezone.utc)
+                if TRANSPORT_MODE == "record":
+                    os.makedirs(CASSETTE_DIR, exist_ok=True)
+                    with open(CLOCK_FILE, "w") as clock_file:
+                        json.dump({"now": FROZEN_TIME.isoformat()}, clock_file)
+        return FROZEN_TIME
+
+# CURRENT TIME (same as datetime.now, frozen while recording or replaying so date params match)
+def now(tz=None) -> datetime:
+    frozen = get_frozen_time()
+    if frozen is None:
+        return datetime.now(tz)
+    if tz is None:
+        return frozen.astimezone().replace(tzinfo=None)
+    return frozen.astimezone(tz)
+
+# BODY FOR UNRECORDED REQUESTS
+def miss_body(provider: str) -> dict:
+    return MISS_BODIES.get(provider, {"message": MISS_MESSAGE})
+
+# NORMALIZES BODY SO EQUIVALENT JSON PAYLOADS SHARE A KEY
+def canonical_body(body) -> str:
+    if body is None or body == b"" or body == "":
+        return ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return body
+    return json.dumps(body, sort_keys=True, default=str)
+
+# KEYS A REST REQUEST BY PROVIDER, METHOD, PATH, NON-SECRET PARAMS AND BODY
+def request_key(provider: str, method: str, url: str, params=None, body=None) -> str:
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True) + list((params or {}).items() if isinstance(params, dict) else params or [])
+    query = sorted((name, str(value)) for name, value in query if name.lower() not in SECRET_PARAMS)
+    return call_key(provider=provider, parts={
+        "method": method.upper(),
+        "path": "/" + parts.path.lstrip("/"),
+        "query": query,
+        "body": canonical_body(body)
+    })
+
+# KEYS AN SDK CALL BY PROVIDER AND CALLER CHOSEN PARTS
+def call_key(provider: str, parts: dict) -> str:
+    return hashlib.sha256(json.dumps([provider, parts], sort_keys=True, default=str).encode()).hexdigest()
+
+# GETS CASSETTE PATH
+def cassette_path(provider: str, key: str) -> str:
+    return os.path.join(CASSETTE_DIR, provider, f"{key}.json")
+
+# LOADS CASSETTE (None when not recorded)
+def load_cassette(provider: str, key: str) -> dict | None:
+    path = cassette_path(provider=provider, key=key)
+    if not os.path.exists(path):
+        return None
+    with open(path) as cassette_file:
+        return json.load(cassette_file)
+
+# SAVES CASSETTE ATOMICALLY
+def save_cassette(provider: str, key: str, cassette: dict):
+    path = cassette_path(provider=provider, key=key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}"
+    with open(temp_path, "w") as cassette_file:
+        json.dump(cassette, cassette_file, indent=2, default=str)
+    os.replace(temp_path, path)
+
+# ENCODES RESPONSE BODY (binary bodies stored as base64)
+def encode_body(content: bytes) -> dict:
+    try:
+        return {"text": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(content).decode()}
+
+def decode_body(body: dict) -> bytes:
+    if "base64" in body:
+        return base64.b64decode(body["base64"])
+    return body["text"].encode("utf-8")
+
+# WAITS THE CONFIGURED REPLAY LATENCY
+def replay_delay(cassette: dict):
+    if REPLAY_LATENCY_MS == "recorded":
+        time.sleep(cassette.get("elapsed_ms", 0) / 1000)
+    elif float(REPLAY_LATENCY_MS) > 0:
+        time.sleep(float(REPLAY_LATENCY_MS) / 1000)
+
+# RECORDS OR REPLAYS A JSON SERIALIZABLE SDK CALL RESULT
+def replayable(provider: str, parts: dict, call):
+    if TRANSPORT_MODE == "live":
+        return call()
+    key = call_key(provider=provider, parts=parts)
+    if TRANSPORT_MODE == "replay":
+        cassette = load_cassette(provider=provider, key=key)
+        if cassette is None:
+            raise LookupError(f"NO CASSETTE FOR {provider}: {parts}")
+        replay_delay(cassette)
+        return cassette["result"]
+    started = time.perf_counter()
+    result = call()
+    save_cassette(provider=provider, key=key, cassette={
+        "parts": parts,
+        "result": result,
+        "elapsed_ms": (time.perf_counter() - started) * 1000
+    })
+    return result
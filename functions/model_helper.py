@@ -4,7 +4,7 @@ import requests
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from google import genai
-from pprint import pprint
+from google.genai import types as genai_types
 from firebase_admin import initialize_app, firestore, credentials
 from google.cloud.firestore_v1.base_query import FieldFilter
 import json
@@ -14,45 +14,286 @@ import os
 from google.cloud import tasks_v2
 from requests_oauthlib import OAuth1Session
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
 from google.cloud import texttospeech_v1beta1 as tts_beta
 from google.oauth2 import service_account
 import os
 from moviepy import AudioFileClip, ImageClip
+from moviepy.config import FFMPEG_BINARY
+import subprocess
 import io
+import wave
 import uuid
 import random
-import tempfile
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from requests.structures import CaseInsensitiveDict
+import model_cassette
+import model_trace
 
 # LOAD ENV VARS
+load_dotenv()
 DEV = False
 if DEV:
     cred = credentials.Certificate("model/firebase.json")
     initialize_app(cred)
+elif os.getenv("FIRESTORE_EMULATOR_HOST"):
+    # Firestore client talks to the local emulator, which only needs a project id
+    initialize_app(options={"projectId": os.getenv("GCLOUD_PROJECT", "demo-nous")})
 else:
     initialize_app()
-load_dotenv()
 
-# LOGGER
-def log(message: str):
-    if True:
-        pprint(message)
+# LOGGER (leveled, sampled json lines nested under the current span)
+def log(message: str, level: str = "info", **fields):
+    model_trace.log(message, level=level, **fields)
+
+# HTTP TRANSPORT CONSTANTS
+HTTP_TIMEOUT = (3.05, 20) # (connect, read) seconds
+HTTP_POOL_SIZE = 16
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+PROVIDERS = {
+    "finnhub": {"base_url": "https://finnhub.io", "retries": 4, "backoff": 1.0},
+    "alpaca_data": {"base_url": "https://data.alpaca.markets", "retries": 3, "backoff": 0.5},
+    "alpaca_trading": {"base_url": "https://paper-api.alpaca.markets", "retries": 3, "backoff": 0.5},
+    "news": {"base_url": "https://newsapi.org", "retries": 2, "backoff": 1.0},
+    "humor": {"base_url": "https://api.humorapi.com", "retries": 1, "backoff": 0.5},
+    "jokeapi": {"base_url": "https://v2.jokeapi.dev", "retries": 1, "backoff": 0.5},
+    "pexels": {"base_url": "https://api.pexels.com", "retries": 2, "backoff": 0.5},
+    "pexels_images": {"base_url": "https://images.pexels.com", "retries": 2, "backoff": 0.5}
+}
+for provider, config in PROVIDERS.items():
+    # Points a provider at a stand-in, e.g. FINNHUB_BASE_URL=http://localhost:8765/finnhub
+    config["base_url"] = os.getenv(f"{provider.upper()}_BASE_URL", config["base_url"]).rstrip("/")
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+# PROVIDER CONCURRENCY LIMITS (max in-flight calls per provider)
+PROVIDER_CONCURRENCY = {
+    "finnhub": 4,
+    "alpaca_data": 8,
+    "alpaca_trading": 4,
+    "news": 2,
+    "llm": 4,
+    "tasks": 4,
+    "twitter": 1,
+    "pexels": 4,
+    "pexels_images": 8
+}
+PROVIDER_SEMAPHORES = {
+    provider: threading.BoundedSemaphore(limit) for provider, limit in PROVIDER_CONCURRENCY.items()
+}
+
+# LIMITS CONCURRENT CALLS TO PROVIDER
+def provider_limit(provider: str):
+    return PROVIDER_SEMAPHORES.get(provider, nullcontext())
+
+# GETS POOLED SESSION FOR PROVIDER (reused across warm invocations)
+def get_session(provider: str) -> requests.Session:
+    with SESSIONS_LOCK:
+        if provider in SESSIONS:
+            return SESSIONS[provider]
+        config = PROVIDERS[provider]
+
+        # Retries only idempotent methods, so order posts are never duplicated
+        retry = Retry(
+            total=config["retries"],
+            connect=config["retries"],
+            read=config["retries"],
+            backoff_factor=config["backoff"],
+            status_forcelist=HTTP_RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount(config["base_url"], adapter)
+        SESSIONS[provider] = session
+        return session
+
+# SENDS REQUEST THROUGH PROVIDER SESSION, TRACED PER CALL
+def http_request(provider: str, method: str, url: str, **kwargs) -> requests.Response:
+    if not url.startswith("http"):
+        url = f"{PROVIDERS[provider]['base_url']}/{url.lstrip('/')}"
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    with model_trace.span(
+        "http",
+        provider=provider,
+        method=method.upper(),
+        endpoint=url.removeprefix(PROVIDERS[provider]["base_url"]).split("?")[0]
+    ) as span:
+        response = send_request(provider, method, url, **kwargs)
+        span.set(status=response.status_code, bytes=len(response.content))
+        return response
+
+# SENDS REQUEST (recorded to or replayed from cassettes per TRANSPORT_MODE)
+def send_request(provider: str, method: str, url: str, **kwargs) -> requests.Response:
+    if model_cassette.TRANSPORT_MODE == "live":
+        with provider_limit(provider):
+            return get_session(provider).request(method, url, **kwargs)
+
+    # Keys on the path below the provider's base url so stand-ins share cassettes
+    key = model_cassette.request_key(
+        provider=provider,
+        method=method,
+        url=url.removeprefix(PROVIDERS[provider]["base_url"]),
+        params=kwargs.get("params"),
+        body=kwargs.get("json", kwargs.get("data"))
+    )
+    if model_cassette.TRANSPORT_MODE == "replay":
+        return replay_response(provider=provider, key=key, url=url)
+    started = time.perf_counter()
+    with provider_limit(provider):
+        response = get_session(provider).request(method, url, **kwargs)
+    model_cassette.save_cassette(provider=provider, key=key, cassette={
+        "request": {"method": method.upper(), "url": url.split("?")[0]},
+        "status": response.status_code,
+        "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+        "body": model_cassette.encode_body(response.content),
+        "elapsed_ms": (time.perf_counter() - started) * 1000
+    })
+    return response
+
+# BUILDS RESPONSE FROM CASSETTE (unrecorded requests get a 404 shaped like provider errors)
+def replay_response(provider: str, key: str, url: str) -> requests.Response:
+    cassette = model_cassette.load_cassette(provider=provider, key=key)
+    response = requests.Response()
+    response.url = url
+    response.encoding = "utf-8"
+    if cassette is None:
+        log(f"NO CASSETTE FOR {provider}: {url}")
+        response.status_code = 404
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        response._content = json.dumps(model_cassette.miss_body(provider)).encode()
+        return response
+    model_cassette.replay_delay(cassette)
+    response.status_code = cassette["status"]
+    response.headers = CaseInsensitiveDict(cassette["headers"])
+    response._content = model_cassette.decode_body(cassette["body"])
+    return response
+
+# IN-PROCESS LRU CACHE WITH EXPIRY
+class LRUCache:
+
+    def __init__(self, maxsize: int = 256, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns (value, stored_at) or None when missing or expired
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value, stored_at: float | None = None):
+        with self.lock:
+            self.entries[key] = (value, stored_at if stored_at is not None else time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+# BACKGROUND WORKERS (stale-while-revalidate refreshes)
+BACKGROUND = ThreadPoolExecutor(max_workers=2)
 
 # GETS TIMESTAMP IN ACCESIBLE FORMAT
 def get_timestamp(with_time=False, delta=4) -> str:
-    now = datetime.now(timezone.utc) - timedelta(hours=delta)
+    now = model_cassette.now(timezone.utc) - timedelta(hours=delta)
     if with_time == False:
         return now.strftime("%Y-%m-%d")
     return now.strftime("%Y-%m-%dT%H")
 
 # GET DATA FROM FINNHUB
 def get_data_finnhub(url: str, params: dict) -> tuple[bool, dict | str]:
-    response = requests.get(f"https://finnhub.io/{url}", params=params)
+    response = http_request("finnhub", "GET", url, params=params)
     response_object = response.json()
     if "message" in response_object:
         return False, response_object["message"]
+    elif "error" in response_object or not response.ok:
+        return False, response_object.get("error", f"STATUS {response.status_code}")
     else:
         return True, response_object
     
+# COMPANY PROFILE CACHE CONSTANTS
+PROFILE_TTL = 60 * 60 * 24 * 7 # served fresh for a week
+PROFILE_MAX_STALE = 60 * 60 * 24 * 90 # served stale (while refreshing) up to 90 days
+PROFILE_CACHE = LRUCache(maxsize=2048, ttl=PROFILE_MAX_STALE)
+PROFILE_REFRESHING = set()
+PROFILE_LOCK = threading.Lock()
+
+# CHECKS IF PROFILE CAN BE CACHED (a named company, or {} for unknown symbols)
+def cacheable_profile(profile) -> bool:
+    return isinstance(profile, dict) and (profile == {} or "name" in profile) and "error" not in profile
+
+# FETCHES COMPANY PROFILE FROM FINNHUB AND STORES IT IN BOTH CACHE TIERS
+def fetch_company_profile(symbol: str) -> tuple[bool, dict | str]:
+    try:
+        success, profile = get_data_finnhub(
+            url="api/v1/stock/profile2",
+            params={
+                "token": os.getenv("STOCKS_API_KEY"),
+                "symbol": symbol
+            }
+        )
+        if success and cacheable_profile(profile):
+            fetched_at = time.time()
+            PROFILE_CACHE.set(symbol, profile, fetched_at)
+            set_database(
+                collection="profiles",
+                document=symbol,
+                data={
+                    "profile": profile,
+                    "fetched_at": fetched_at
+                }
+            )
+        return success, profile
+    finally:
+        with PROFILE_LOCK:
+            PROFILE_REFRESHING.discard(symbol)
+
+# GETS COMPANY PROFILE (memory, then firestore, then finnhub)
+def get_company_profile(symbol: str) -> tuple[bool, dict | str]:
+
+    # Checks in-process cache then durable cache
+    entry = PROFILE_CACHE.get(symbol)
+    if entry is None:
+        document = get_database(
+            collection="profiles",
+            document=symbol
+        )
+        if (document and cacheable_profile(document.get("profile"))
+                and time.time() - document["fetched_at"] < PROFILE_MAX_STALE):
+            PROFILE_CACHE.set(symbol, document["profile"], document["fetched_at"])
+            entry = (document["profile"], document["fetched_at"])
+    if entry is None:
+        return fetch_company_profile(symbol)
+
+    # Serves stale entries immediately and refreshes them in the background
+    profile, fetched_at = entry
+    if time.time() - fetched_at > PROFILE_TTL:
+        with PROFILE_LOCK:
+            refresh = symbol not in PROFILE_REFRESHING
+            PROFILE_REFRESHING.add(symbol)
+        if refresh:
+            BACKGROUND.submit(model_trace.propagate(fetch_company_profile), symbol)
+    return True, profile
+
 # GET DATA FROM ALPACA
 def get_data_alpaca(url: str, market=False) -> tuple[bool, dict | str]:
     headers = {
@@ -60,12 +301,11 @@ def get_data_alpaca(url: str, market=False) -> tuple[bool, dict | str]:
         "APCA-API-KEY-ID": os.getenv("MARKET_API_KEY_DEV"),
         "APCA-API-SECRET-KEY": os.getenv("MARKET_API_SECRET_DEV")
     }
-    if market:
-        response = requests.get(f"https://data.alpaca.markets/{url}", headers=headers)
-    else:
-        response = requests.get(f"https://paper-api.alpaca.markets/{url}", headers=headers)
-    print(response.json())
+    provider = "alpaca_data" if market else "alpaca_trading"
+    response = http_request(provider, "GET", url, headers=headers)
     response_object = response.json()
+    if model_trace.enabled("debug"):
+        log("ALPACA RESPONSE", level="debug", url=url, payload=response_object)
     if "message" in response_object:
         return False, response_object["message"]
     else:
@@ -79,7 +319,7 @@ def post_data_alpaca(url: str, payload: dict) -> tuple[bool, dict | str]:
         "APCA-API-KEY-ID": os.getenv("MARKET_API_KEY_DEV"),
         "APCA-API-SECRET-KEY": os.getenv("MARKET_API_SECRET_DEV")
     }
-    response = requests.post(f"https://paper-api.alpaca.markets/{url}", headers=headers, json=payload)
+    response = http_request("alpaca_trading", "POST", url, headers=headers, json=payload)
     response_object = response.json()
     if "message" in response_object:
         return False, response_object["message"]
@@ -88,69 +328,271 @@ def post_data_alpaca(url: str, payload: dict) -> tuple[bool, dict | str]:
     
 # GET DATA FROM NEWS API
 def get_data_news(url: str, params: dict) -> tuple[bool, dict | str]:
-    response = requests.get(f"https://newsapi.org/{url}", params=params)
+    response = http_request("news", "GET", url, params=params)
     response_object = response.json()
     if response_object["status"] == "error":
         return False, response_object["message"]
     else:
-        return True, response.json()
-
-# INTERFACE WITH LLM
-def ask_llm(prompt: str):
-    client = genai.Client(api_key=os.getenv("GOOGLE_GENAI_API_KEY"))
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt
+        return True, response_object
+
+# LLM CONSTANTS
+LLM_MODEL = "gemini-2.5-flash"
+LLM_CACHE_TTL = 60 * 60 * 6
+LLM_CACHE = LRUCache(maxsize=256, ttl=LLM_CACHE_TTL)
+LLM_CACHE_DURABLE = os.getenv("LLM_CACHE_DURABLE", "false").lower() == "true"
+LLM_CLIENT = None
+LLM_CLIENT_LOCK = threading.Lock()
+
+# GETS SHARED LLM CLIENT
+def get_llm_client() -> genai.Client:
+    global LLM_CLIENT
+    with LLM_CLIENT_LOCK:
+        if LLM_CLIENT is None:
+            LLM_CLIENT = genai.Client(api_key=os.getenv("GOOGLE_GENAI_API_KEY"))
+        return LLM_CLIENT
+
+# INTERFACE WITH LLM (responses cached by hash of model and prompt)
+def ask_llm(prompt: str, model: str = LLM_MODEL, cache: bool = True, schema: dict | None = None):
+    key = hashlib.sha256(f"{model}\n{json.dumps(schema, sort_keys=True)}\n{prompt}".encode()).hexdigest()
+
+    # Parses structured responses
+    def parse(text: str):
+        return json.loads(text) if schema is not None else text
+
+    # Checks in-process cache then optional durable cache
+    if cache:
+        entry = LLM_CACHE.get(key)
+        if entry is not None:
+            return parse(entry[0])
+        if LLM_CACHE_DURABLE:
+            document = get_database(
+                collection="llm_cache",
+                document=key
+            )
+            if document and time.time() - document["created_at"] < LLM_CACHE_TTL:
+                LLM_CACHE.set(key, document["text"], document["created_at"])
+                return parse(document["text"])
+
+    # Asks model (json mode constrained to schema when provided)
+    config = None
+    if schema is not None:
+        config = genai_types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=schema
+        )
+    def generate() -> str:
+        with provider_limit("llm"), model_trace.span("llm", provider="llm", endpoint=model) as span:
+            text = get_llm_client().models.generate_content(
+                model=model,
+                contents=prompt,
+                config=config
+            ).text
+            span.set(bytes=len(text or ""))
+            return text
+    text = model_cassette.replayable(
+        provider="llm",
+        parts={"model": model, "schema": schema, "prompt": prompt},
+        call=generate
     )
-    return response.text
+    result = parse(text)
+
+    # Stores response
+    if cache and text:
+        created_at = time.time()
+        LLM_CACHE.set(key, text, created_at)
+        if LLM_CACHE_DURABLE:
+            set_database(
+                collection="llm_cache",
+                document=key,
+                data={
+                    "model": model,
+                    "text": text,
+                    "created_at": created_at,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=LLM_CACHE_TTL)
+                }
+            )
+    return result
+
+# FIRESTORE CONSTANTS
+FIRESTORE_BATCH_LIMIT = 500 # max writes per commit
+FIRESTORE_PAGE_SIZE = int(os.getenv("FIRESTORE_PAGE_SIZE", 200))
+FIRESTORE_CLIENT = None
+FIRESTORE_CLIENT_LOCK = threading.Lock()
+
+# GETS SHARED FIRESTORE CLIENT
+def get_firestore_client() -> firestore.Client:
+    global FIRESTORE_CLIENT
+    with FIRESTORE_CLIENT_LOCK:
+        if FIRESTORE_CLIENT is None:
+            FIRESTORE_CLIENT = firestore.client()
+        return FIRESTORE_CLIENT
+
+# MERGES NESTED MAPS THE SAME WAY AS set(merge=True)
+def merge_data(base: dict, update: dict) -> dict:
+    merged = dict(base)
+    for field, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(field), dict):
+            merged[field] = merge_data(merged[field], value)
+        else:
+            merged[field] = dict(value) if isinstance(value, dict) else value
+    return merged
+
+# FIRESTORE WRITE BUFFER (coalesces merges per document into batched commits)
+class WriteBuffer:
+
+    def __init__(self, flush_size: int = FIRESTORE_BATCH_LIMIT):
+        self.flush_size = flush_size
+        self.writes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def set(self, collection: str, document: str, data: dict):
+        with self.lock:
+            key = (collection, document)
+            self.writes[key] = merge_data(self.writes.get(key, {}), data)
+            full = len(self.writes) >= self.flush_size
+        if full:
+            self.flush()
+
+    # Commits buffered documents, returns number written
+    def flush(self) -> int:
+        with self.lock:
+            writes = list(self.writes.items())
+            self.writes = OrderedDict()
+        firestore_client = get_firestore_client()
+        for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            batch = firestore_client.batch()
+            for (collection, document), data in writes[i:i+FIRESTORE_BATCH_LIMIT]:
+                batch.set(firestore_client.collection(collection).document(document), data, merge=True)
+            with model_trace.span("firestore", provider="firestore", endpoint="commit", writes=min(FIRESTORE_BATCH_LIMIT, len(writes) - i)):
+                batch.commit()
+        return len(writes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
 
 # INTERFACE WITH FIRESTORE (Modify)
 def set_database(collection: str, document: str, data: dict):
-    firestore_client: firestore.client = firestore.client()
-    firestore_client.collection(collection).document(document).set(data, merge=True)
+    firestore_client: firestore.Client = get_firestore_client()
+    with model_trace.span("firestore", provider="firestore", endpoint=f"set {collection}"):
+        firestore_client.collection(collection).document(document).set(data, merge=True)
     return True
 
 # INTERFACE WITH FIRESTORE (Retrieve)
 def get_database(collection: str, document: str):
-    firestore_client: firestore.Client = firestore.client()
+    firestore_client: firestore.Client = get_firestore_client()
     ref = firestore_client.collection(collection).document(document)
-    return ref.get().to_dict()
+    with model_trace.span("firestore", provider="firestore", endpoint=f"get {collection}") as span:
+        data = ref.get().to_dict()
+        span.set(found=data is not None)
+    return data
+
+# INTERFACE WITH FIRESTORE (Stream group, projected and paginated)
+def stream_database_collection(
+    collection: str, 
+    field: str, 
+    value: str, 
+    operator: str, 
+    fields: list | None = None, 
+    order_by: str = "__name__",
+    page_size: int = FIRESTORE_PAGE_SIZE
+):
+    firestore_client: firestore.Client = get_firestore_client()
+    query = firestore_client.collection(collection).where(filter=FieldFilter(field, operator, value))
+
+    # Projects fields server side (cursor field must be included)
+    if fields is not None:
+        if order_by != "__name__" and order_by not in fields:
+            fields = fields + [order_by]
+        query = query.select(fields)
+    query = query.order_by(order_by).limit(page_size)
+
+    # Pages through results with a cursor
+    cursor = None
+    while True:
+        page = query.start_after(cursor) if cursor is not None else query
+        with model_trace.span("firestore", provider="firestore", endpoint=f"query {collection}") as span:
+            docs = list(page.stream())
+            span.set(documents=len(docs))
+        for doc in docs:
+            yield doc.id, doc.to_dict()
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1]
 
 # INTERFACE WITH FIRESTORE (Retrieve group)
 def get_database_collection(collection: str, field: str, value: str, operator: str, key: str):
-    firestore_client: firestore.client = firestore.client()
-    docs = (
-        firestore_client.collection(collection)
-        .where(filter=FieldFilter(field, operator, value))
-        .stream()
-    )
     ids = []
     documents = []
-    for doc in docs:
-        ids.append(doc.id)
-        documents.append(doc.to_dict()[key])
+    for id, doc in stream_database_collection(
+        collection=collection,
+        field=field,
+        value=value,
+        operator=operator,
+        fields=[key]
+    ):
+        ids.append(id)
+        documents.append(doc[key])
     return ids, documents
 
-# GETS FIREBASE FUNCTION URL
+# CLOUD TASKS CONSTANTS
+TASKS_PROJECT = "nous-486de"
+TASKS_LOCATION = "us-central1"
+TASKS_SERVICE_ACCOUNT = "firebase-adminsdk-fbsvc@nous-486de.iam.gserviceaccount.com"
+TASKS_WORKERS = 4
+FUNCTION_URL_TTL = 60 * 60 * 6
+FUNCTION_URL_CACHE = LRUCache(maxsize=32, ttl=FUNCTION_URL_TTL)
+GOOGLE_CLIENTS = {}
+GOOGLE_CLIENTS_LOCK = threading.Lock()
+
+# GETS SHARED CLOUD TASKS CLIENT
+def get_tasks_client() -> tasks_v2.CloudTasksClient:
+    with GOOGLE_CLIENTS_LOCK:
+        if "tasks" not in GOOGLE_CLIENTS:
+            GOOGLE_CLIENTS["tasks"] = tasks_v2.CloudTasksClient()
+        return GOOGLE_CLIENTS["tasks"]
+
+# GETS SHARED AUTHORIZED SESSION FOR GOOGLE APIS
+def get_authed_session() -> tuple[AuthorizedSession, str]:
+    with GOOGLE_CLIENTS_LOCK:
+        if "authed_session" not in GOOGLE_CLIENTS:
+            credentials, project_id = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            GOOGLE_CLIENTS["authed_session"] = (AuthorizedSession(credentials), project_id)
+        return GOOGLE_CLIENTS["authed_session"]
+
+# GETS FIREBASE FUNCTION URL (memoized)
 def get_function_url(name: str, location: str = "us-central1") -> str:
-    credentials, project_id = google.auth.default(
-        scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    authed_session = AuthorizedSession(credentials)
+    key = f"{location}/{name}"
+    entry = FUNCTION_URL_CACHE.get(key)
+    if entry is not None:
+        return entry[0]
+    authed_session, project_id = get_authed_session()
     url = ("https://cloudfunctions.googleapis.com/v2beta/" +
            f"projects/{project_id}/locations/{location}/functions/{name}")
     response = authed_session.get(url)
     data = response.json()
     function_url = data["serviceConfig"]["uri"]
+    FUNCTION_URL_CACHE.set(key, function_url)
     return function_url
 
 # QUEUES TASK IN FIREBASE FUNCTIONS
 def queue_task(function_id: str, data: dict, execute_time: datetime):
-    client = tasks_v2.CloudTasksClient()
-    project = "nous-486de"
+
+    # Keyed without the api key and generated order id so replays match across runs
+    payload = {name: value for name, value in data.get("data", {}).items() if name not in ("key", "id")}
+    return model_cassette.replayable(
+        provider="tasks",
+        parts={"function_id": function_id, "data": payload, "execute_time": execute_time},
+        call=lambda: create_task(function_id=function_id, data=data, execute_time=execute_time)
+    )
+
+def create_task(function_id: str, data: dict, execute_time: datetime):
+    client = get_tasks_client()
     queue = function_id
-    location = "us-central1"
-    service_account_email = "firebase-adminsdk-fbsvc@nous-486de.iam.gserviceaccount.com"
-    parent = client.queue_path(project, location, queue)
+    parent = client.queue_path(TASKS_PROJECT, TASKS_LOCATION, queue)
     task = tasks_v2.Task(http_request={
             "http_method": tasks_v2.HttpMethod.POST,
             "url": get_function_url(function_id),
@@ -159,16 +601,43 @@ def queue_task(function_id: str, data: dict, execute_time: datetime):
             },
             "body": json.dumps(data).encode(),
             "oidc_token": {
-                "service_account_email": service_account_email
+                "service_account_email": TASKS_SERVICE_ACCOUNT
             }
         },
         schedule_time=execute_time
     )
-    response = client.create_task(parent=parent, task=task)
+    with provider_limit("tasks"), model_trace.span("tasks", provider="tasks", endpoint=queue):
+        response = client.create_task(parent=parent, task=task)
     return response.name
 
+# QUEUES MANY TASKS CONCURRENTLY, RETURNS (success, name or error) PER TASK
+def queue_tasks(function_id: str, tasks: list[tuple[dict, datetime]]) -> list[tuple[bool, str]]:
+
+    # Resolves url once before fanning out (replays never reach cloud tasks)
+    if model_cassette.TRANSPORT_MODE != "replay":
+        get_function_url(function_id)
+
+    def create(task: tuple[dict, datetime]) -> tuple[bool, str]:
+        data, execute_time = task
+        try:
+            return True, queue_task(function_id=function_id, data=data, execute_time=execute_time)
+        except Exception as error:
+            log(f"TASK QUEUE FAILED: {error}")
+            return False, str(error)
+
+    with ThreadPoolExecutor(max_workers=TASKS_WORKERS) as executor:
+        return list(executor.map(model_trace.propagate(create), tasks))
+
 # POSTS TWEET VIA TWITTER API V2
 def create_tweet(payload: dict):
+    success, result = model_cassette.replayable(
+        provider="twitter",
+        parts={"payload": payload},
+        call=lambda: post_tweet(payload=payload)
+    )
+    return success, result
+
+def post_tweet(payload: dict):
 
     # Make the request
     oauth = OAuth1Session(
@@ -179,10 +648,12 @@ def create_tweet(payload: dict):
     )
 
     # Making the request
-    response = oauth.post(
-        "https://api.twitter.com/2/tweets",
-        json=payload,
-    )
+    with provider_limit("twitter"), model_trace.span("twitter", provider="twitter", endpoint="/2/tweets") as span:
+        response = oauth.post(
+            "https://api.twitter.com/2/tweets",
+            json=payload,
+        )
+        span.set(status=response.status_code, bytes=len(response.content))
     if response.status_code != 201:
         log(f"TWEET POST FAILED: {response.status_code} {response.text}")
         return False, response.text
@@ -190,13 +661,12 @@ def create_tweet(payload: dict):
     # Returns tweet id
     return True, response.json()["data"]["id"]
 
-# CONVERT TEXT TO SSML
+# CONVERT TEXT TO SSML (mark names are positional so identical scripts give identical requests)
 def convert_text_ssml(words_array: list):
     words = words_array
     ssml = "<speak>"
-    for word in words:
-        id = "".join(char for char in f"{word}{uuid.uuid4()}" if char.isalnum())
-        ssml += f" {word} <mark name='{id}'/>"
+    for index, word in enumerate(words):
+        ssml += f" {word} <mark name='w{index}'/>"
     ssml += "</speak>"
     return ssml
 
@@ -206,8 +676,10 @@ def get_joke() -> tuple[bool, str, str]:
     try:
 
         # Gets joke from humour api
-        res = requests.get(
-            url="https://api.humorapi.com/jokes/random",
+        res = http_request(
+            "humor",
+            "GET",
+            url="jokes/random",
             params={
                 "exclude-tags": "racist,nsfw",
                 "max-length": 500,
@@ -222,8 +694,10 @@ def get_joke() -> tuple[bool, str, str]:
     except Exception as error:
 
         # Gets joke from alternative api
-        res = requests.get(
-            url="https://v2.jokeapi.dev/joke/Any?type=single"
+        res = http_request(
+            "jokeapi",
+            "GET",
+            url="joke/Any?type=single"
         )
         res_obj = res.json()
         if res_obj["error"] == False:
@@ -234,78 +708,272 @@ def get_joke() -> tuple[bool, str, str]:
         else:
             return False, "", ""
         
-# GENERATE TTS USING GOOGLE TEXT-TO-SPEECH BETA API
-def gen_tts_beta(words_array: list):
+# TTS CONSTANTS
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "/tmp/tts_cache")
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", 64)) # /tmp is in memory on cloud functions
+TTS_MAX_SSML_BYTES = 4500 # request limit is 5000 bytes
+TTS_SAMPLE_RATE = 24000
+TTS_WORKERS = 4
+TTS_MP3_BITRATE = "128k"
+TTS_VOICE = {
+    "language_code": "en-AU",
+    "name": "en-AU-Wavenet-B"
+}
 
-    # Credentials
-    credentials = service_account.Credentials.from_service_account_info({
-        "type": "service_account",
-        "project_id": "nous-486de",
-        "private_key_id": os.getenv("GOOGLE_PRIVATE_KEY_ID"),
-        "private_key": os.getenv("GOOGLE_PRIVATE_KEY"),
-        "client_email": os.getenv("GOOGLE_CLIENT_EMAIL"),
-        "client_id": os.getenv("GOOGLE_CLIENT_ID"),
-        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-        "token_uri": "https://oauth2.googleapis.com/token",
-        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-        "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/firebase-adminsdk-fbsvc%40nous-486de.iam.gserviceaccount.com",
-        "universe_domain": "googleapis.com"
-    })
+# GETS SHARED TEXT-TO-SPEECH CLIENT
+def get_tts_client() -> tts_beta.TextToSpeechClient:
+    with GOOGLE_CLIENTS_LOCK:
+        if "tts" not in GOOGLE_CLIENTS:
 
-    # Instantiates a client
-    client = tts_beta.TextToSpeechClient(credentials=credentials)
+            # Credentials
+            credentials = service_account.Credentials.from_service_account_info({
+                "type": "service_account",
+                "project_id": "nous-486de",
+                "private_key_id": os.getenv("GOOGLE_PRIVATE_KEY_ID"),
+                "private_key": os.getenv("GOOGLE_PRIVATE_KEY"),
+                "client_email": os.getenv("GOOGLE_CLIENT_EMAIL"),
+                "client_id": os.getenv("GOOGLE_CLIENT_ID"),
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+                "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/firebase-adminsdk-fbsvc%40nous-486de.iam.gserviceaccount.com",
+                "universe_domain": "googleapis.com"
+            })
 
-    # Convert text input to ssml to be synthesized
-    ssml = convert_text_ssml(words_array=words_array)
+            # Instantiates a client
+            GOOGLE_CLIENTS["tts"] = tts_beta.TextToSpeechClient(credentials=credentials)
+        return GOOGLE_CLIENTS["tts"]
+
+# WRITES FILE ATOMICALLY (concurrent readers never see partial files)
+def write_file_atomic(path: str, content: bytes | str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}"
+    with open(temp_path, "wb" if isinstance(content, bytes) else "w") as out:
+        out.write(content)
+    os.replace(temp_path, path)
+
+# PRUNES DISK CACHE TO SIZE (entries are files sharing a key, least recently used go first)
+CACHE_PRUNE_LOCK = threading.Lock()
+def prune_cache(directory: str, max_mb: float):
+    if not CACHE_PRUNE_LOCK.acquire(blocking=False):
+        return
+    try:
+        entries = {}
+        with os.scandir(directory) as files:
+            for file in files:
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                entry = entries.setdefault(file.name.split(".")[0], {"paths": [], "bytes": 0, "used": 0})
+                entry["paths"].append(file.path)
+                entry["bytes"] += stat.st_size
+                entry["used"] = max(entry["used"], stat.st_mtime)
+        total = sum(entry["bytes"] for entry in entries.values())
+        for entry in sorted(entries.values(), key=lambda entry: entry["used"]):
+            if total <= max_mb * 1024 * 1024:
+                break
+            for path in entry["paths"]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= entry["bytes"]
+    finally:
+        CACHE_PRUNE_LOCK.release()
+
+# SYNTHESIZES SSML, RETURNS (audio bytes, mark times in seconds)
+def synthesize_ssml(ssml: str, audio_encoding: tts_beta.AudioEncoding = tts_beta.AudioEncoding.MP3):
     synthesis_input = tts_beta.SynthesisInput(ssml=ssml)
 
     # Build the voice request, select the language code, and the ssml voice gender
     voice = tts_beta.VoiceSelectionParams(
-        language_code="en-AU",
-        name="en-AU-Wavenet-B",
+        language_code=TTS_VOICE["language_code"],
+        name=TTS_VOICE["name"],
         ssml_gender=tts_beta.SsmlVoiceGender.MALE,
     )
 
     # Select the type of audio file you want returned
-    audio_config = tts_beta.AudioConfig(
-        audio_encoding=tts_beta.AudioEncoding.MP3
-    )
+    audio_config = tts_beta.AudioConfig(audio_encoding=audio_encoding)
+    if audio_encoding == tts_beta.AudioEncoding.LINEAR16:
+        audio_config.sample_rate_hertz = TTS_SAMPLE_RATE
 
     # Perform the text-to-speech request on the text input with the selected voice parameters and audio file type
-    response = client.synthesize_speech(
-        request=tts_beta.SynthesizeSpeechRequest(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config,
-            enable_time_pointing=[
-                tts_beta.SynthesizeSpeechRequest.TimepointType.SSML_MARK
-            ]
-        )
+    def synthesize() -> dict:
+        with model_trace.span("tts", provider="tts", endpoint="synthesize_speech") as span:
+            response = get_tts_client().synthesize_speech(
+                request=tts_beta.SynthesizeSpeechRequest(
+                    input=synthesis_input,
+                    voice=voice,
+                    audio_config=audio_config,
+                    enable_time_pointing=[
+                        tts_beta.SynthesizeSpeechRequest.TimepointType.SSML_MARK
+                    ]
+                )
+            )
+            span.set(bytes=len(response.audio_content))
+        return {
+            "audio": model_cassette.encode_body(response.audio_content),
+            "times": [t.time_seconds for t in response.timepoints]
+        }
+    result = model_cassette.replayable(
+        provider="tts",
+        parts={"ssml": ssml, "voice": TTS_VOICE, "audio_encoding": int(audio_encoding)},
+        call=synthesize
     )
+    return model_cassette.decode_body(result["audio"]), result["times"]
+
+# SPLITS WORDS INTO SENTENCE ALIGNED CHUNKS WHOSE SSML FITS THE REQUEST LIMIT
+def split_tts_chunks(words_array: list, max_bytes: int = TTS_MAX_SSML_BYTES) -> list:
+
+    # Groups words into sentences
+    sentences = [[]]
+    for word in words_array:
+        sentences[-1].append(word)
+        if word[-1] in ".!?":
+            sentences.append([])
+    sentences = [sentence for sentence in sentences if len(sentence) > 0]
+
+    # Packs sentences into chunks (oversized sentences are split by word)
+    def size(word: str, index: int) -> int:
+        return len(f" {word} <mark name='w{index}'/>".encode())
+
+    base_size = len("<speak></speak>".encode())
+    chunks = [[]]
+    chunk_size = base_size
+    for sentence in sentences:
+        sentence_size = sum(size(word, len(chunks[-1]) + i) for i, word in enumerate(sentence))
+        if len(chunks[-1]) > 0 and chunk_size + sentence_size > max_bytes:
+            chunks.append([])
+            chunk_size = base_size
+        for word in sentence:
+            word_size = size(word, len(chunks[-1]))
+            if len(chunks[-1]) > 0 and chunk_size + word_size > max_bytes:
+                chunks.append([])
+                chunk_size = base_size
+            chunks[-1].append(word)
+            chunk_size += word_size
+    return chunks
+
+# SYNTHESIZES CHUNKS CONCURRENTLY AND STITCHES THEM, RETURNS (wav bytes, mark times in seconds)
+def synthesize_chunks(chunks: list):
+    with ThreadPoolExecutor(max_workers=TTS_WORKERS) as executor:
+        results = list(executor.map(
+            model_trace.propagate(lambda chunk: synthesize_ssml(
+                ssml=convert_text_ssml(words_array=chunk),
+                audio_encoding=tts_beta.AudioEncoding.LINEAR16
+            )),
+            chunks
+        ))
+
+    # Concatenates pcm and offsets each chunk's marks by the audio before it
+    output = io.BytesIO()
+    times = []
+    offset = 0
+    with wave.open(output, "wb") as stitched:
+        for index, (audio_content, chunk_times) in enumerate(results):
+            with wave.open(io.BytesIO(audio_content), "rb") as chunk_audio:
+                if index == 0:
+                    stitched.setparams(chunk_audio.getparams())
+                frames = chunk_audio.readframes(chunk_audio.getnframes())
+                duration = chunk_audio.getnframes() / chunk_audio.getframerate()
+            stitched.writeframes(frames)
+            times += [offset + time for time in chunk_times]
+            offset += duration
+    return output.getvalue(), times
+
+# ENCODES WAV BYTES AS MP3 (stitched pcm would otherwise be muxed into videos uncompressed)
+def encode_mp3(wav_content: bytes) -> bytes:
+    return subprocess.run(
+        [FFMPEG_BINARY, "-loglevel", "error", "-f", "wav", "-i", "pipe:0", "-c:a", "libmp3lame", "-b:a", TTS_MP3_BITRATE, "-f", "mp3", "pipe:1"],
+        input=wav_content,
+        capture_output=True,
+        check=True
+    ).stdout
+
+# GENERATE TTS USING GOOGLE TEXT-TO-SPEECH BETA API (cached on disk by voice and words)
+def gen_tts_beta(words_array: list):
+
+    # Long scripts are synthesized as chunks
+    ssml = convert_text_ssml(words_array=words_array)
+    chunked = len(ssml.encode()) > TTS_MAX_SSML_BYTES
+
+    # Checks cache
+    key = hashlib.sha256(json.dumps({"voice": TTS_VOICE, "words": words_array}).encode()).hexdigest()
+    audio_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    marks_path = os.path.join(TTS_CACHE_DIR, f"{key}.json")
+    if os.path.exists(audio_path) and os.path.exists(marks_path):
+        os.utime(audio_path)
+        with open(marks_path) as marks_file:
+            return AudioFileClip(audio_path), json.load(marks_file)
+
+    # Synthesizes speech
+    if chunked:
+        audio_content, marks = synthesize_chunks(
+            chunks=split_tts_chunks(words_array=words_array)
+        )
+        audio_content = encode_mp3(wav_content=audio_content)
+    else:
+        audio_content, marks = synthesize_ssml(ssml=ssml)
 
     # Creates timestamps
-    marks = [t.time_seconds for t in response.timepoints]
     marks.insert(0, 0)
     marks = [y-x for x, y in zip(marks[:-1], marks[1:])]
 
-    temp = tempfile.NamedTemporaryFile(suffix=".mp3")
-    with open(temp.name, "wb") as out:
-        out.write(response.audio_content)
-    return AudioFileClip(temp.name), marks
+    # Stores audio and marks (audio is written last so a hit always has both)
+    write_file_atomic(marks_path, json.dumps(marks))
+    write_file_atomic(audio_path, audio_content)
+    prune_cache(directory=TTS_CACHE_DIR, max_mb=TTS_CACHE_MAX_MB)
+    return AudioFileClip(audio_path), marks
 
-# GETS PHOTOS USING PEXELS API
-def get_photo(query: str):
+# PHOTO CONSTANTS
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", "/tmp/photo_cache")
+PHOTO_CACHE_MAX_MB = float(os.getenv("PHOTO_CACHE_MAX_MB", 128)) # /tmp is in memory on cloud functions
+PHOTO_WORKERS = 8
+PHOTO_STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "of", "to", "in", "on", "at", "by", "for", "with", "from", 
+    "as", "is", "are", "was", "were", "be", "been", "am", "it", "its", "it's", "this", "that", "these", 
+    "those", "i", "i'm", "me", "my", "we", "our", "you", "your", "he", "she", "his", "her", "they", "them", 
+    "their", "so", "do", "does", "did", "not", "no", "just", "than", "then", "there", "here", "will", "would", 
+    "can", "could", "should", "has", "have", "had", "what", "which", "who", "how", "when", "where", "about", 
+    "up", "down", "out", "into", "over", "very", "too", "also", "only", "some", "any", "all", "more", "most"
+}
+
+# NORMALIZES WORD TO PHOTO QUERY ("" when not worth searching)
+def get_photo_query(word: str) -> str:
+    query = "".join(char for char in word if char.isalnum() or char == "'").lower().strip("'")
+    if len(query) < 2 or query in PHOTO_STOPWORDS:
+        return ""
+    return query
+
+# FETCHES PHOTO INTO ON-DISK CACHE KEYED BY QUERY, RETURNS (success, (page url, image path))
+def fetch_photo(query: str) -> tuple[bool, tuple[str, str] | object]:
     try:
 
+        # Checks cache
+        key = hashlib.sha256(query.lower().encode()).hexdigest()
+        image_path = os.path.join(PHOTO_CACHE_DIR, f"{key}.jpg")
+        meta_path = os.path.join(PHOTO_CACHE_DIR, f"{key}.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta["url"] is None:
+                return False, meta
+            if os.path.exists(image_path):
+                os.utime(meta_path)
+                return True, (meta["url"], image_path)
+
         # Perform api request
-        response = requests.get(
-            url="https://api.pexels.com/v1/search",
+        response = http_request(
+            "pexels",
+            "GET",
+            url="v1/search",
             params={
                 "query": query,
                 "orientation": "portrait"
             },
             headers={
-                "Authorization": "XLvFuG4LIUV3ABjxUPoGUvMuLaY6ZnFQ2GlcpYu8KHQIwj1Z5nYoYTov"
+                "Authorization": os.getenv("PEXELS_API_KEY")
             }
         )
         response_obj = response.json()
@@ -313,18 +981,45 @@ def get_photo(query: str):
 
             # Read image response
             results_photos = response_obj["photos"]
-            result_cursor = random.randint(0, len(results_photos)-1)
+            chooser = random if model_cassette.TRANSPORT_MODE == "live" else random.Random(query) # replays pick the recorded photo
+            result_cursor = chooser.randint(0, len(results_photos)-1)
             result_obj = results_photos[result_cursor]
 
-            # Convert image url to ImageClip for moviepy
-            image_url = result_obj["src"]["portrait"]
-            response = requests.get(image_url, stream=True)
-            image_data = io.BytesIO(response.content)
-        
-            return True, (result_obj["url"], ImageClip(image_data))
+            # Downloads image by path so stand-ins for the image host apply (written atomically)
+            image_url = urlsplit(result_obj["src"]["portrait"])._replace(scheme="", netloc="").geturl()
+            response = http_request("pexels_images", "GET", image_url)
+            content_type = response.headers.get("Content-Type", "")
+            if not response.ok or not content_type.startswith("image/"):
+                log(f"ERROR WITH PHOTO DOWNLOAD: {response.status_code} {content_type}")
+                return False, response
+            write_file_atomic(image_path, response.content)
+            meta = {"query": query, "url": result_obj["url"]}
         else:
             log(f"ERROR WITH PHOTO RETRIEVAL: {response_obj}")
+            meta = {"query": query, "url": None}
+        write_file_atomic(meta_path, json.dumps(meta))
+        prune_cache(directory=PHOTO_CACHE_DIR, max_mb=PHOTO_CACHE_MAX_MB)
+        if meta["url"] is None:
             return False, response_obj
+        return True, (meta["url"], image_path)
     except Exception as error:
         log(f"ERROR WITH PHOTO REQUEST: {error}")
-        return False, error
\ No newline at end of file
+        return False, error
+
+# GETS PHOTOS USING PEXELS API
+def get_photo(query: str):
+    success, photo = fetch_photo(query=query)
+    if success:
+        return True, (photo[0], ImageClip(photo[1]))
+    return False, photo
+
+# GETS PHOTOS FOR MANY WORDS (deduped, stopwords skipped), RETURNS {query: (page url, image path)}
+def get_photos(words: list) -> dict:
+    queries = list(dict.fromkeys(
+        query for query in (get_photo_query(word) for word in words) if query != ""
+    ))
+    with ThreadPoolExecutor(max_workers=PHOTO_WORKERS) as executor:
+        results = list(executor.map(model_trace.propagate(fetch_photo), queries))
+    return {
+        query: photo for query, (success, photo) in zip(queries, results) if success
+    }
@@ -0,0 +1,124 @@
+
+# DEPENDENCIES
+import argparse
+import os
+import threading
+import numpy as np
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+# MARKET DATA CONSTANTS
+MARKET_DATA_DIR = os.getenv("MARKET_DATA_DIR", "/tmp/market_data")
+MARKET_TIMEZONE = "America/New_York"
+BARS_PAGE_LIMIT = 10000
+BARS_DEFAULT_START = "2024-01-01T00:00:00Z"
+BAR_DTYPE = np.dtype([
+    ("t", "<i8"), # epoch seconds (utc)
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<f8"),
+    ("vwap", "<f8")
+])
+SYNC_LOCK = threading.Lock()
+
+# GETS PATH OF SYMBOL'S BAR FILE (fixed width records, append only)
+def get_bars_path(symbol: str, timeframe: str = "1Min") -> str:
+    return os.path.join(MARKET_DATA_DIR, timeframe, f"{symbol}.bars")
+
+# READS ALL STORED BARS AS A READ ONLY MEMORY MAP
+def read_bars(symbol: str, timeframe: str = "1Min") -> np.ndarray:
+    path = get_bars_path(symbol=symbol, timeframe=timeframe)
+    if not os.path.exists(path) or os.path.getsize(path) < BAR_DTYPE.itemsize:
+        return np.empty(0, dtype=BAR_DTYPE)
+    return np.memmap(path, dtype=BAR_DTYPE, mode="r", shape=(os.path.getsize(path) // BAR_DTYPE.itemsize,))
+
+# GETS BARS IN [start, end) AS A ZERO COPY SLICE OF THE MEMORY MAP
+def get_bars(symbol: str, start: datetime, end: datetime, timeframe: str = "1Min") -> np.ndarray:
+    bars = read_bars(symbol=symbol, timeframe=timeframe)
+    lower, upper = np.searchsorted(bars["t"], [int(start.timestamp()), int(end.timestamp())], side="left")
+    return bars[lower:upper]
+
+# CONVERTS ALPACA BARS TO RECORDS
+def to_records(raw_bars: list) -> np.ndarray:
+    records = np.empty(len(raw_bars), dtype=BAR_DTYPE)
+    records["t"] = np.array([bar["t"][:19] for bar in raw_bars], dtype="datetime64[s]").astype(np.int64)
+    for field, key in [("open", "o"), ("high", "h"), ("low", "l"), ("close", "c"), ("volume", "v"), ("vwap", "vw")]:
+        records[field] = [bar.get(key, np.nan) for bar in raw_bars]
+    return records
+
+# SYNCS NEW BARS FROM ALPACA AFTER THE LAST STORED TIMESTAMP, RETURNS NUMBER APPENDED
+def sync_bars(symbol: str, timeframe: str = "1Min", start: str = BARS_DEFAULT_START) -> int:
+
+    # Imported here so offline readers (backtests) do not initialize firebase
+    import model_helper
+
+    with SYNC_LOCK:
+
+        # Resumes after last stored bar
+        stored = read_bars(symbol=symbol, timeframe=timeframe)
+        last = int(stored["t"][-1]) if len(stored) > 0 else None
+        if last is not None:
+            start = datetime.fromtimestamp(last + 1, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        del stored
+
+        # Pages through bars and appends them
+        path = get_bars_path(symbol=symbol, timeframe=timeframe)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        appended = 0
+        page_token = None
+        while True:
+            url = f"v2/stocks/{symbol}/bars?timeframe={timeframe}&start={start}&limit={BARS_PAGE_LIMIT}&adjustment=raw&sort=asc"
+            if page_token:
+                url += f"&page_token={page_token}"
+            success, response = model_helper.get_data_alpaca(url=url, market=True)
+            if not success:
+                model_helper.log(f"FAILED TO SYNC BARS: {response}")
+                break
+            records = to_records(response.get("bars") or [])
+            if last is not None:
+                records = records[records["t"] > last]
+            if len(records) > 0:
+                with open(path, "ab") as bars_file:
+                    bars_file.write(records.tobytes())
+                last = int(records["t"][-1])
+                appended += len(records)
+            page_token = response.get("next_page_token")
+            if not page_token:
+                break
+        return appended
+
+# CONVERTS UTC EPOCH SECONDS TO NAIVE EXCHANGE LOCAL TIMES (offset resolved once per day)
+def to_local_times(epoch_seconds: np.ndarray, zone: str = MARKET_TIMEZONE) -> np.ndarray:
+    days, inverse = np.unique(epoch_seconds // 86400, return_inverse=True)
+    offsets = np.array([
+        int(datetime.fromtimestamp(int(day) * 86400 + 43200, tz=ZoneInfo(zone)).utcoffset().total_seconds())
+        for day in days
+    ], dtype=np.int64)
+    return (epoch_seconds + offsets[inverse]).astype("datetime64[s]")
+
+# LOADS STORED BARS IN THE BACKTESTER'S FORMAT
+def load_backtest_bars(symbols: list, timeframe: str = "1Min") -> dict:
+    bars = {}
+    for symbol in set(symbols):
+        stored = read_bars(symbol=symbol, timeframe=timeframe)
+        if len(stored) > 0:
+            bars[symbol] = {
+                "t": to_local_times(stored["t"]),
+                "open": stored["open"],
+                "high": stored["high"],
+                "low": stored["low"],
+                "close": stored["close"]
+            }
+    return bars
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Syncs alpaca bars into the local market data store")
+    parser.add_argument("symbols", nargs="+", help="symbols to sync")
+    parser.add_argument("--timeframe", default="1Min", help="alpaca bar timeframe")
+    parser.add_argument("--start", default=BARS_DEFAULT_START, help="rfc3339 start for symbols with no stored bars")
+    args = parser.parse_args()
+    for symbol in dict.fromkeys(symbol.upper() for symbol in args.symbols):
+        appended = sync_bars(symbol=symbol, timeframe=args.timeframe, start=args.start)
+        print(f"{symbol}: {appended} bars appended to {get_bars_path(symbol=symbol, timeframe=args.timeframe)}")
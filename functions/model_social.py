@@ -6,8 +6,48 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
+from googleapiclient.discovery_cache.base import Cache
 import json
+import os
+import time
+import random
+import hashlib
+import httplib2
 import model_helper
+import model_cassette
+import model_trace
+
+# UPLOAD CONSTANTS
+UPLOAD_CHUNK_SIZE = int(os.getenv("YOUTUBE_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)) # multiple of 256 KB
+UPLOAD_MAX_RETRIES = 8
+UPLOAD_RETRIABLE_STATUSES = (500, 502, 503, 504)
+UPLOAD_RETRIABLE_ERRORS = (httplib2.HttpLib2Error, ConnectionError, TimeoutError, OSError)
+
+# SERVICE CACHE (service objects and the credentials last stored for each channel)
+SERVICES = {}
+
+# DISCOVERY DOCUMENT CACHE (memory, then /tmp)
+class DiscoveryCache(Cache):
+
+    def __init__(self, directory: str = "/tmp/discovery_cache"):
+        self.directory = directory
+        self.documents = {}
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+    def get(self, url: str):
+        if url not in self.documents and os.path.exists(self.path(url)):
+            with open(self.path(url)) as document:
+                self.documents[url] = document.read()
+        return self.documents.get(url)
+
+    def set(self, url: str, content: str):
+        self.documents[url] = content
+        model_helper.write_file_atomic(self.path(url), content)
+
+DISCOVERY_CACHE = DiscoveryCache()
 
 # YOUTUBE VIDEO INTERFACE
 class YouTubeClient():
@@ -60,7 +100,7 @@ class YouTubeClient():
             data=json.loads(creds.to_json())
         )
 
-    # Function to interface with YouTube API
+    # Function to interface with YouTube API (service cached per channel)
     def createService(self, channel_token_name: str):
         try:
 
@@ -69,21 +109,41 @@ class YouTubeClient():
             API_VERSION = self.version
             SCOPES = self.scopes
 
-            # Gets creds
-            client_token = self.getChannelToken(name=channel_token_name)
-            creds = Credentials.from_authorized_user_info(
-                info=client_token,
-                scopes=SCOPES
-            )
-            model_helper.set_database(
-                collection="creds",
-                document=channel_token_name,
-                data=json.loads(creds.to_json())
-            )
+            # Gets creds (reuses cached ones when present)
+            if channel_token_name in SERVICES:
+                cached = SERVICES[channel_token_name]
+                creds = cached["creds"]
+            else:
+                cached = None
+                client_token = self.getChannelToken(name=channel_token_name)
+                creds = Credentials.from_authorized_user_info(
+                    info=client_token,
+                    scopes=SCOPES
+                )
+
+            # Refreshes token and writes it back only when it changed
+            if not creds.valid and creds.refresh_token:
+                creds.refresh(Request())
+            stored_token = cached["stored_token"] if cached else client_token
+            current_token = json.loads(creds.to_json())
+            if current_token != stored_token:
+                model_helper.set_database(
+                    collection="creds",
+                    document=channel_token_name,
+                    data=current_token
+                )
 
-            # Builds service
-            self.service = build(API_SERVICE_NAME, API_VERSION, credentials=creds, static_discovery=False)
-            print(API_SERVICE_NAME, API_VERSION, 'service created successfully')
+            # Builds service (discovery document cached)
+            if cached:
+                self.service = cached["service"]
+            else:
+                self.service = build(API_SERVICE_NAME, API_VERSION, credentials=creds, static_discovery=False, cache=DISCOVERY_CACHE)
+                print(API_SERVICE_NAME, API_VERSION, 'service created successfully')
+            SERVICES[channel_token_name] = {
+                "service": self.service,
+                "creds": creds,
+                "stored_token": current_token
+            }
             return True
         
         except Exception as e:
@@ -121,13 +181,14 @@ class YouTubeClient():
                 'notifySubscribers': False
             }
             
-            # Uploads video
-            media_file = MediaFileUpload(video_file)
-            response_video_upload = self.service.videos().insert(
+            # Uploads video in resumable chunks
+            media_file = MediaFileUpload(video_file, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+            request = self.service.videos().insert(
                 part='snippet,status',
                 body=video_metadata,
                 media_body=media_file
-            ).execute()
+            )
+            response_video_upload = self.resumeUpload(request=request)
             return True, response_video_upload.get("id")
         
         except Exception as error:
@@ -136,6 +197,28 @@ class YouTubeClient():
             print(f"YouTube video upload failed with this error: {error}")
             return False, ""
     
+    # Sends chunks until done, resuming from the last acknowledged offset after transient errors
+    def resumeUpload(self, request) -> dict:
+        response = None
+        retries = 0
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+                retries = 0
+            except HttpError as error:
+                if error.resp.status not in UPLOAD_RETRIABLE_STATUSES or retries >= UPLOAD_MAX_RETRIES:
+                    raise
+                retries += 1
+                model_helper.log(f"YOUTUBE UPLOAD RETRY {retries}: {error}", level="warning")
+                time.sleep(min(2 ** retries, 64) * random.random())
+            except UPLOAD_RETRIABLE_ERRORS as error:
+                if retries >= UPLOAD_MAX_RETRIES:
+                    raise
+                retries += 1
+                model_helper.log(f"YOUTUBE UPLOAD RETRY {retries}: {error}", level="warning")
+                time.sleep(min(2 ** retries, 64) * random.random())
+        return response
+
     # Sets thumbnail for video (Quota Cost: 50 units)
     def setThumbnail(
         self, 
@@ -215,15 +298,26 @@ def upload_video(
 ):
     
     # Generate video
-    youtube_api = YouTubeClient()
-    youtube_api.createService(channel_token_name=type)
-    success, id = youtube_api.uploadVideo(
-        video_file=filename,
-        title=title,
-        description=description,
-        tags=tags,
-        category_id=category_id,
-        privacy_status=privacy_status
+    def upload() -> tuple[bool, str]:
+        youtube_api = YouTubeClient()
+        youtube_api.createService(channel_token_name=type)
+        with model_trace.span("youtube", provider="youtube", endpoint="videos.insert") as span:
+            success, id = youtube_api.uploadVideo(
+                video_file=filename,
+                title=title,
+                description=description,
+                tags=tags,
+                category_id=category_id,
+                privacy_status=privacy_status
+            )
+            span.set(bytes=os.path.getsize(filename), uploaded=success)
+        return success, id
+
+    # Replays are keyed by metadata, not the rendered file
+    success, id = model_cassette.replayable(
+        provider="youtube",
+        parts={"type": type, "title": title, "tags": tags},
+        call=upload
     )
 
     if success:
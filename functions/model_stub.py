@@ -0,0 +1,69 @@
+
+# DEPENDENCIES
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import model_cassette
+
+# STUB SERVER CONSTANTS
+STUB_HOST = "127.0.0.1"
+STUB_PORT = 8765
+
+# SERVES RECORDED CASSETTES AT /<provider>/<path> (point <PROVIDER>_BASE_URL at http://host:port/<provider>)
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(method="GET")
+
+    def do_POST(self):
+        self.respond(method="POST")
+
+    def do_DELETE(self):
+        self.respond(method="DELETE")
+
+    def respond(self, method: str):
+        provider, _, path = self.path.lstrip("/").partition("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        key = model_cassette.request_key(
+            provider=provider,
+            method=method,
+            url=f"/{path}",
+            body=body
+        )
+        cassette = model_cassette.load_cassette(provider=provider, key=key)
+        if cassette is None:
+            status = 404
+            headers = {"Content-Type": "application/json"}
+            content = json.dumps(model_cassette.miss_body(provider)).encode()
+        else:
+            model_cassette.replay_delay(cassette)
+            status = cassette["status"]
+            headers = cassette["headers"]
+            content = model_cassette.decode_body(cassette["body"])
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args):
+        pass
+
+# RUNS STUB SERVER
+def serve(host: str = STUB_HOST, port: int = STUB_PORT):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    print(f"SERVING {model_cassette.CASSETTE_DIR} ON http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves recorded provider cassettes over HTTP")
+    parser.add_argument("--host", default=STUB_HOST)
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port)
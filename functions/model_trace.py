@@ -0,0 +1,148 @@
+
+# DEPENDENCIES
+import contextvars
+import functools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+# TRACE CONSTANTS
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL_NAME = os.getenv("LOG_LEVEL", "info").lower()
+LOG_LEVEL = LOG_LEVELS.get(LOG_LEVEL_NAME, LOG_LEVELS["info"]) # unknown names fall back to info
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1)) # fraction of debug lines and spans emitted
+LOG_LOCK = threading.Lock()
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+CURRENT_INVOCATION = contextvars.ContextVar("current_invocation", default=None)
+
+# CHECKS IF LEVEL IS EMITTED (lets callers skip building verbose payloads)
+def enabled(level: str) -> bool:
+    return LOG_LEVELS[level] >= LOG_LEVEL
+
+# WRITES ONE STRUCTURED LOG LINE (severity and message are read by cloud logging)
+def log(message, level: str = "info", **fields):
+    if not enabled(level):
+        return
+    if level == "debug" and random.random() >= LOG_SAMPLE_RATE:
+        return
+    record = {"severity": level.upper(), "message": message if isinstance(message, str) else repr(message)}
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        record.update(trace_id=span.trace_id, span_id=span.span_id)
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with LOG_LOCK:
+        sys.stdout.write(line + "\n")
+
+if LOG_LEVEL_NAME not in LOG_LEVELS:
+    log(f"UNKNOWN LOG_LEVEL {LOG_LEVEL_NAME}, USING info", level="warning")
+
+# TIMED UNIT OF WORK NESTED UNDER THE CURRENT SPAN (provider calls carry provider and endpoint)
+class Span:
+    def __init__(self, name: str, **attributes):
+        parent = CURRENT_SPAN.get()
+        self.name = name
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.latency_ms = None
+        self.token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.token = CURRENT_SPAN.set(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.latency_ms = (time.perf_counter() - self.started) * 1000
+        if exc is not None:
+            self.attributes.setdefault("error", repr(exc))
+        CURRENT_SPAN.reset(self.token)
+        invocation = CURRENT_INVOCATION.get()
+        if invocation is not None and "provider" in self.attributes:
+            invocation.record(span=self)
+
+        # Failed spans are always logged, the rest are sampled
+        log(
+            f"span {self.name}",
+            level="warning" if exc is not None else "debug",
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            latency_ms=round(self.latency_ms, 2),
+            **self.attributes
+        )
+        return False
+
+def span(name: str, **attributes) -> Span:
+    return Span(name, **attributes)
+
+# COLLECTS PROVIDER LATENCIES FOR ONE FUNCTION INVOCATION
+class Invocation:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, span: Span):
+        provider = span.attributes["provider"]
+        with self.lock:
+            calls = self.calls.setdefault(provider, {"latencies": [], "errors": 0, "bytes": 0})
+            calls["latencies"].append(span.latency_ms)
+            calls["bytes"] += span.attributes.get("bytes") or 0
+            status = span.attributes.get("status")
+            if "error" in span.attributes or (isinstance(status, int) and status >= 400):
+                calls["errors"] += 1
+
+    # Summarizes calls per provider (nearest rank percentiles)
+    def summary(self) -> dict:
+        def percentile(latencies: list, fraction: float) -> float:
+            return round(latencies[max(0, math.ceil(len(latencies) * fraction) - 1)], 2)
+        summary = {}
+        with self.lock:
+            for provider, calls in self.calls.items():
+                latencies = sorted(calls["latencies"])
+                summary[provider] = {
+                    "calls": len(latencies),
+                    "errors": calls["errors"],
+                    "bytes": calls["bytes"],
+                    "p50_ms": percentile(latencies, 0.5),
+                    "p95_ms": percentile(latencies, 0.95)
+                }
+        return summary
+
+# TRACES A FUNCTION ENTRY POINT AND LOGS ITS PROVIDER SUMMARY
+def instrumented(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            invocation = Invocation(name)
+            token = CURRENT_INVOCATION.set(invocation)
+            try:
+                with span(name, invocation=name) as root:
+                    return function(*args, **kwargs)
+            finally:
+                CURRENT_INVOCATION.reset(token)
+                log(
+                    f"invocation {name}",
+                    latency_ms=round(root.latency_ms or 0, 2),
+                    providers=invocation.summary()
+                )
+        return wrapper
+    return decorator
+
+# CARRIES CURRENT SPAN AND INVOCATION INTO POOL THREADS (each call runs in its own copy)
+def propagate(function):
+    context = contextvars.copy_context()
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
@@ -1,10 +1,14 @@
 
 # DEPENDENCIES
 import model_helper
+import model_trace
+import model_cassette
 from datetime import datetime, timedelta
 import os
 import json
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from firebase_admin import firestore, functions
 
 # EARNINGS OBJECT
@@ -25,7 +29,7 @@ class EarningsObject:
                 self.time = "na"
         self.buy_time = self.date + self.time if isinstance(self.time, timedelta) else self.date
         self.eps_est = float(eps_est if eps_est != None else 0)
-        if self.time != "na" and self.buy_time > datetime.now() and self.eps_est > 0:
+        if self.time != "na" and self.buy_time > model_cassette.now() and self.eps_est > 0:
             self.elgible = True
         else:
             self.elgible = False
@@ -50,37 +54,246 @@ class IpoObject:
     def __str__(self):
         return f"{self.symbol} - {self.date} - {self.expected_price} - {self.buy_time}"
 
+# SNAPSHOT CONSTANTS
+SNAPSHOT_CHUNK_SIZE = 100
+SNAPSHOT_SYMBOL_ERROR = "invalid symbol" # alpaca's 400 message when a chunk holds an unknown symbol
+ENRICH_WORKERS = 4
+
+# GETS CURRENT PRICES FOR MANY SYMBOLS (one request per chunk, chunks with a bad symbol are split)
+def get_stock_prices(symbols: list, chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> dict:
+    symbols = list(dict.fromkeys(symbols))
+    prices = {}
+    chunks = [symbols[i:i+chunk_size] for i in range(0, len(symbols), chunk_size)]
+    while chunks:
+        chunk = chunks.pop()
+        success, snapshots = model_helper.get_data_alpaca(
+            url=f"/v2/stocks/snapshots?symbols={','.join(chunk)}",
+            market=True
+        )
+
+        # Halves chunks rejected for a bad symbol so it only loses its own price
+        if not success:
+            if SNAPSHOT_SYMBOL_ERROR not in str(snapshots).lower():
+                model_helper.log(f"FAILED TO GET STOCK PRICES: {snapshots}", level="error")
+                break
+            if len(chunk) > 1:
+                chunks += [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]]
+            else:
+                model_helper.log(f"FAILED TO GET STOCK PRICE: {chunk[0]} {snapshots}", level="error")
+            continue
+        for symbol in chunk:
+            snapshot = snapshots.get(symbol)
+            prices[symbol] = float(snapshot["dailyBar"]["vw"]) if (snapshot and "dailyBar" in snapshot) else None
+    return prices
+
+# RESOLVES PRICES AND NAMES FOR MANY ORDERS IN BULK
+def enrich_orders(orders: list) -> list:
+    prices = get_stock_prices(
+        symbols=[order.symbol for order in orders if order.type == "earnings"]
+    )
+    for order in orders:
+        if order.type == "earnings":
+            order.price = prices.get(order.symbol)
+
+    # Company names have no bulk endpoint, so they resolve on a small pool
+    with ThreadPoolExecutor(max_workers=ENRICH_WORKERS) as executor:
+        list(executor.map(
+            model_trace.propagate(lambda order: order.name if order.elgible else None),
+            orders
+        ))
+    return orders
+
+# EXECUTION SLOTS OBJECT (caps scheduled orders across worker threads)
+class ExecutionSlots:
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.committed = 0
+        self.pending = 0
+        self.condition = threading.Condition()
+
+    @property
+    def full(self):
+        with self.condition:
+            return self.committed >= self.limit
+
+    # Waits while in-flight reservations could still free a slot
+    def reserve(self) -> bool:
+        with self.condition:
+            while self.committed < self.limit and self.committed + self.pending >= self.limit:
+                self.condition.wait()
+            if self.committed >= self.limit:
+                return False
+            self.pending += 1
+            return True
+
+    def commit(self):
+        with self.condition:
+            self.pending -= 1
+            self.committed += 1
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+# BRACKET MULTIPLIERS PER STANCE (chosen by model_backtest sweep)
+BRACKET_CONFIG = os.getenv("BRACKET_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bracket_config.json"))
+with open(BRACKET_CONFIG) as bracket_file:
+    BRACKETS = json.load(bracket_file)
+
+# ANALYSIS CONSTANTS
+ANALYSIS_STANCES = ["bearish", "bullish", "neutral"]
+ANALYSIS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "symbol": {"type": "STRING"},
+            "summary": {"type": "STRING"},
+            "stance": {"type": "STRING", "enum": ANALYSIS_STANCES},
+            "defense": {"type": "STRING"}
+        },
+        "required": ["symbol", "summary", "stance", "defense"]
+    }
+}
+
+# CHECKS ANALYSIS RESULT MATCHES SCHEMA
+def valid_analysis(res) -> bool:
+    return (
+        isinstance(res, dict)
+        and all(isinstance(res.get(field), str) for field in ["symbol", "summary", "stance", "defense"])
+        and res["stance"] in ANALYSIS_STANCES
+    )
+
+# ANALYZES MANY ORDERS WITH ONE LLM CALL
+def analyze_orders(orders: list) -> list:
+
+    # Gets news (orders without articles are canceled)
+    ready = []
+    for order in orders:
+        order.sources = [article["url"] for article in order.news]
+        if len(order.news) > 0:
+            ready.append(order)
+        else:
+            model_helper.log(f"INSUFFICIENT NUMBER OF ARTICLES TO ANALYZE", level="warning")
+            order.status = "canceled_insuff_articles"
+            order.elgible = False
+    if len(ready) == 0:
+        return orders
+
+    # Asks for one structured result per symbol
+    companies = [
+        {
+            "symbol": order.symbol,
+            "name": order.name,
+            "articles": order.news
+        }
+        for order in ready
+    ]
+    try:
+        res = model_helper.ask_llm(
+            prompt=f"""For each company below, review the list of articles which mention it 
+            and write a concise 100-150 word summary of all the articles combined without mentioning 'the articles'. 
+            Also choose one of the following stances (bearish, bullish, neutral) and defend it. 
+            Return exactly one result per company, identified by its symbol. 
+            Companies: {json.dumps(companies, default=str)}""",
+            schema=ANALYSIS_SCHEMA
+        )
+        results = {item["symbol"]: item for item in res if valid_analysis(item)}
+    except Exception as error:
+        model_helper.log(f"AI ANALYSIS FAILED: {error}", level="error")
+        results = {}
+    for order in ready:
+        order.applyAnalysis(results.get(order.symbol))
+    return orders
+
+# MARKS FIELDS WHICH HAVE NOT BEEN FETCHED YET
+UNRESOLVED = object()
+
 # ORDER OBJECT
 class Order:
 
-    def __init__(self, symbol: str, object: IpoObject | EarningsObject):
+    def __init__(self, symbol: str, object: IpoObject | EarningsObject, lazy: bool = False):
         self.id = str(uuid.uuid1())
         self.symbol = symbol
         self.object = object
         if isinstance(object, IpoObject):
             self.type = "ipo" 
-            self.price = self.object.expected_price
-            self.name = self.object.name
+            self._price = self.object.expected_price
+            self._name = self.object.name
         else:
             self.type = "earnings"
-            self.price = self.getCurrStockPrice()
-            self.name = self.getCompanyName()
+            self._price = UNRESOLVED
+            self._name = UNRESOLVED
+        self._news = UNRESOLVED
+        self._elgible = None
         self.execute_time = self.object.buy_time - timedelta(minutes=5)
         self.execute_time = self.execute_time + timedelta(hours=4) # timezone adjustment for central server time
-        self.elgible = True if self.price != None else False
         self.tweet_id = "failed"
 
+        # Lazy orders resolve price, name and news on first access
+        if not lazy:
+            self.price
+            self.name
+
+    @property
+    def price(self):
+        if self._price is UNRESOLVED:
+            self._price = self.getCurrStockPrice()
+        return self._price
+
+    @price.setter
+    def price(self, value: float | None):
+        self._price = value
+
+    @property
+    def name(self):
+        if self._name is UNRESOLVED:
+            self._name = self.getCompanyName()
+        return self._name
+
+    @name.setter
+    def name(self, value: str):
+        self._name = value
+
+    @property
+    def news(self):
+        if self._news is UNRESOLVED:
+            self._news = self.getNews()
+        return self._news
+
+    @news.setter
+    def news(self, value: list):
+        self._news = value
+
+    @property
+    def elgible(self):
+        if self._elgible is None:
+            return True if self.price != None else False
+        return self._elgible
+
+    @elgible.setter
+    def elgible(self, value: bool):
+        self._elgible = value
+
+    # Ranks using calendar fields only, so no lookups are triggered
+    def getRankKey(self):
+        return (
+            self.execute_time,
+            -getattr(self.object, "rev", 0),
+            -getattr(self.object, "eps_est", 0)
+        )
+
     def getCompanyName(self):
-        success, company_profile = model_helper.get_data_finnhub(
-            url="api/v1/stock/profile2",
-            params={
-                "token": os.getenv("STOCKS_API_KEY"),
-                "symbol": self.symbol
-            }
+        success, company_profile = model_helper.get_company_profile(
+            symbol=self.symbol
         )
         if not success:
-            model_helper.log(f"FAILED TO GET COMPANY INFO: {company_profile}")
-        return company_profile["name"]
+            model_helper.log(f"FAILED TO GET COMPANY INFO: {company_profile}", level="error")
+            return self.symbol
+        return company_profile.get("name", self.symbol)
 
     def getCurrStockPrice(self):
         success, stock_price = model_helper.get_data_alpaca(
@@ -88,7 +301,7 @@ class Order:
             market=True
         )
         if not success:
-            model_helper.log(f"FAILED TO GET STOCK PRICE: {stock_price}")
+            model_helper.log(f"FAILED TO GET STOCK PRICE: {stock_price}", level="error")
         return float(stock_price["dailyBar"]["vw"]) if (success and "dailyBar" in stock_price) else None
     
     def getNews(self):
@@ -105,70 +318,64 @@ class Order:
             }
         )
         if not success:
-            model_helper.log(f"FAILED TO GET NEWS: {news}")
+            model_helper.log(f"FAILED TO GET NEWS: {news}", level="error")
+            return []
         return news["articles"]
     
     def analyzeAI(self):
-        self.news = self.getNews()
-        self.sources = [article["url"] for article in self.news]
-        if len(self.news) > 0:
-            try:
-                res = model_helper.ask_llm(
-                    prompt=f"""Review the following list of articles which mention {self.name} 
-                    and write a concise 100-150 word summary of all the articles combined without mentioning 'the articles'. 
-                    Also choose one of the following stances (bearish, bullish, neutral) and defend it. 
-                    Return the response in a structured json output which matches the following: 
-                    {{ summary: __________, stance: ______________, defense: ______________ }}. 
-                    Articles: {self.news}""",
-                )
-                res = json.loads(res[res.index("{"): res.index("}")+1])
-                self.overview = res["summary"]
-                self.stance = res["stance"]
-                self.defense = res["defense"]
-                match self.stance:
-                    case "bearish":
-                        self.price_upper = 1.05
-                        self.price_lower = .95
-                    case "bullish":
-                        self.price_upper = 1.1
-                        self.price_lower = .9
-                    case _:
-                        self.price_upper = 1.02
-                        self.price_lower = 0.98
-                self.status = "order_created"
-            except Exception as error:
-                model_helper.log(f"AI ANALYSIS FAILED: {error}")
-                self.status = "canceled_ai_analy_fail"
-                self.elgible = False
-        else:
-            model_helper.log(f"INSUFFICIENT NUMBER OF ARTICLES TO ANALYZE")
-            self.status = "canceled_insuff_articles"
+        analyze_orders(orders=[self])
+
+    # Applies one schema validated analysis result (None when analysis failed)
+    def applyAnalysis(self, res: dict | None):
+        if res is None:
+            model_helper.log(f"AI ANALYSIS FAILED: {self.symbol}", level="error")
+            self.status = "canceled_ai_analy_fail"
             self.elgible = False
+            return
+        self.overview = res["summary"]
+        self.stance = res["stance"]
+        self.defense = res["defense"]
+        bracket = BRACKETS.get(self.stance, BRACKETS["neutral"])
+        self.price_upper = bracket["upper"]
+        self.price_lower = bracket["lower"]
+        self.price_safety = bracket["safety"]
+        self.status = "order_created"
     
-    def updateDatabase(self):
+    def updateDatabase(self, buffer: model_helper.WriteBuffer | None = None):
         if self.elgible:
-            model_helper.set_database(
-                collection="actions",
-                document=self.id,
-                data=self.getDict()
-            )
+            if buffer is not None:
+                buffer.set(
+                    collection="actions",
+                    document=self.id,
+                    data=self.getDict()
+                )
+            else:
+                model_helper.set_database(
+                    collection="actions",
+                    document=self.id,
+                    data=self.getDict()
+                )
+
+    # Task payload for createstockorder (also used with model_helper.queue_tasks)
+    def getTaskData(self):
+        return {
+            "data": {
+                "key": os.getenv("NOUS_API_KEY"),
+                "id": self.id,
+                "symbol": self.symbol,
+                "amount": 1,
+                "current_price": self.price,
+                "upper": self.price_upper,
+                "lower": self.price_lower,
+                "lower_safety": self.price_lower - self.price_safety,
+            }
+        }
 
     def scheduleTask(self):
         if self.elgible:
             model_helper.queue_task(
                 function_id="createstockorder",
-                data={
-                    "data": {
-                        "key": os.getenv("NOUS_API_KEY"),
-                        "id": self.id,
-                        "symbol": self.symbol,
-                        "amount": 1,
-                        "current_price": self.price,
-                        "upper": self.price_upper,
-                        "lower": self.price_lower,
-                        "lower_safety": self.price_lower - 0.01,
-                    }
-                },
+                data=self.getTaskData(),
                 execute_time=self.execute_time
             )
             self.status = "scheduled"
@@ -11,27 +11,75 @@ from moviepy import (
     concatenate_videoclips
 )
 from moviepy.decorators import requires_duration
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from moviepy.config import FFMPEG_BINARY
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+import numpy as np
+import os
+import shutil
+import subprocess
+import tempfile
 import model_helper
 
 # VIDEO CONSTANTS
-VIDEO_TIME = 0
-CLIP_TIME = 0
+ASPECT_RATIO = (1080, 1920)
+RENDER_FPS = 24
+PROGRESS_BAR_COLOR = (255, 255, 255)
+PROGRESS_BAR_HEIGHT = 20
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+VIDEO_ENCODING = os.getenv("VIDEO_ENCODING", "still") # still, segmented or frames
+STILL_ENCODER_SETTINGS = [
+    "-c:v", "libx264",
+    "-preset", "veryfast",
+    "-tune", "stillimage",
+    "-pix_fmt", "yuv420p",
+    "-threads", str(RENDER_WORKERS)
+]
+ENCODER_SETTINGS = {
+    "codec": "libx264",
+    "preset": "medium"
+}
 
-# ADDS PROGRESS BAR TO CLIP
+# SCENE OBJECT (one word on screen over an absolute time range)
+class Scene:
+
+    def __init__(self, text: str, duration: float, start: float = 0, photo: str = "", fontsize: int = 150, style: int = 1):
+        self.text = text
+        self.duration = duration
+        self.start = start
+        self.end = start + duration
+        self.photo = photo
+        self.fontsize = fontsize
+        self.style = style
+
+# CREATES SCENES WITH PRECOMPUTED START OFFSETS
+def create_scenes(words: list, durations: list, images: list) -> list:
+    starts = np.concatenate(([0], np.cumsum(durations)[:-1]))
+    return [
+        Scene(
+            text=word,
+            duration=duration,
+            start=float(start),
+            photo="" if image == "not found" else image,
+            fontsize=random.randint(75, 175)
+        )
+        for word, duration, start, image in zip(words, durations, starts, images)
+    ]
+
+# ADDS PROGRESS BAR TO CLIP (start is the clip's offset within the video)
 @requires_duration
 def add_progress_bar(
     clip: VideoClip, 
     color: tuple, 
     total_duration: float, 
+    start: float = 0,
     height: int = 20
 ):
 
     def filter(get_frame, t):
-        global CLIP_TIME, VIDEO_TIME
-        if t < CLIP_TIME:
-            VIDEO_TIME += CLIP_TIME
-        CLIP_TIME = t
-        progression = (VIDEO_TIME + CLIP_TIME) / total_duration
+        progression = (start + t) / total_duration
         bar_width = int(progression * clip.w)
         frame = get_frame(t)
         frame[0:height, :bar_width] = color
@@ -67,11 +115,232 @@ def render_video(
     
     return filename
 
+# GETS FONT FOR STYLE
+def get_font(style: int = 1) -> str:
+    match style:
+        case 1:
+            return "fonts/fragile-bombers.otf"
+        case 2:
+            return "fonts/fragile-bombers-attack.otf"
+        case 3:
+            return "fonts/fragile-bombers-down.otf"
+        case _:
+            return "fonts/fragile-bombers.otf"
+
+# LOADS PHOTO RESIZED TO FRAME WIDTH (shared by scenes using the same photo)
+@lru_cache(maxsize=32)
+def load_photo(path: str, width: int) -> Image.Image:
+    photo = Image.open(path).convert("RGB")
+    return photo.resize((width, round(photo.height * width / photo.width)))
+
+# RASTERIZES SCENE INTO A SINGLE FRAME (same layout as create_text_clip)
+def rasterize_scene(
+    scene: Scene,
+    text_stroke_width: int = 10,
+    text_stroke_color: tuple = (0,0,0),
+    text_color: tuple = (255,255,255),
+    bg_color: tuple = (0,0,0),
+    aspect_ratio: tuple[int, int] = ASPECT_RATIO
+) -> np.ndarray:
+
+    # Draws background and photo
+    width, height = aspect_ratio
+    frame = Image.new("RGB", aspect_ratio, bg_color)
+    if scene.photo:
+        photo = load_photo(scene.photo, width)
+        frame.paste(photo, (0, (height - photo.height) // 2))
+
+    # Draws shadow then stroked text, centered in the same box as the TextClips
+    draw = ImageDraw.Draw(frame)
+    font = ImageFont.truetype(get_font(style=scene.style), scene.fontsize)
+    center_y = round(height/2) - scene.fontsize + round(scene.fontsize*1.5) / 2
+    draw.text((width/2, center_y + 10), scene.text, font=font, fill=(0,0,0), anchor="mm")
+    draw.text(
+        (width/2, center_y), 
+        scene.text, 
+        font=font, 
+        fill=text_color, 
+        stroke_width=text_stroke_width, 
+        stroke_fill=text_stroke_color, 
+        anchor="mm"
+    )
+    return np.asarray(frame)
+
+# STREAMS RASTERIZED SCENES STRAIGHT TO THE ENCODER (scenes may be a contiguous slice of the video)
+def render_frames(
+    scenes: list,
+    filename: str,
+    audio_file: str | None = None,
+    total_duration: float | None = None,
+    fps: int = RENDER_FPS,
+    aspect_ratio: tuple[int, int] = ASPECT_RATIO
+) -> str:
+
+    # Maps frames on the video's global grid to scenes and progress bar widths
+    total_duration = total_duration if total_duration is not None else scenes[-1].end
+    first_frame = int(np.ceil(round(scenes[0].start * fps, 6)))
+    last_frame = int(np.ceil(round(scenes[-1].end * fps, 6)))
+    times = np.arange(first_frame, last_frame) / fps
+    starts = np.array([scene.start for scene in scenes])
+    scene_indexes = np.clip(np.searchsorted(starts, times, side="right") - 1, 0, len(scenes) - 1)
+    bar_widths = (times / total_duration * aspect_ratio[0]).astype(int)
+
+    # Rasterizes each scene once and draws the bar on a reused buffer
+    frame = np.empty((aspect_ratio[1], aspect_ratio[0], 3), dtype=np.uint8)
+    scene_frame, scene_index = None, -1
+    with FFMPEG_VideoWriter(filename, size=aspect_ratio, fps=fps, audiofile=audio_file, **ENCODER_SETTINGS) as writer:
+        for index, bar_width in zip(scene_indexes, bar_widths):
+            if index != scene_index:
+                scene_frame, scene_index = rasterize_scene(scene=scenes[index], aspect_ratio=aspect_ratio), index
+            np.copyto(frame, scene_frame)
+            frame[0:PROGRESS_BAR_HEIGHT, :bar_width] = PROGRESS_BAR_COLOR
+            writer.write_frame(frame)
+    return filename
+
+# SPLITS SCENES INTO CONTIGUOUS CHUNKS OF ROUGHLY EQUAL DURATION
+def split_scenes(scenes: list, chunks: int) -> list:
+    starts = np.array([scene.start for scene in scenes])
+    bounds = np.searchsorted(starts, np.linspace(0, scenes[-1].end, chunks + 1)[1:-1])
+    bounds = [0] + sorted(set(bounds.tolist()) - {0, len(scenes)}) + [len(scenes)]
+    return [scenes[lower:upper] for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+# RENDERS SEGMENTS IN A PROCESS POOL AND JOINS THEM WITHOUT RE-ENCODING
+def render_segmented(
+    scenes: list,
+    filename: str,
+    audio_file: str | None = None,
+    workers: int = RENDER_WORKERS,
+    fps: int = RENDER_FPS
+) -> str:
+
+    # Encodes segments with identical settings
+    segments_dir = tempfile.mkdtemp(prefix="segments_", dir="/tmp")
+    try:
+        chunks = split_scenes(scenes=scenes, chunks=workers)
+        segment_files = [os.path.join(segments_dir, f"segment_{i}.mp4") for i in range(len(chunks))]
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            list(executor.map(
+                render_frames,
+                chunks,
+                segment_files,
+                [None] * len(chunks),
+                [scenes[-1].end] * len(chunks),
+                [fps] * len(chunks)
+            ))
+
+        # Joins segments with the concat demuxer and muxes in audio
+        list_file = os.path.join(segments_dir, "segments.txt")
+        with open(list_file, "w") as segments:
+            segments.writelines(f"file '{segment_file}'\n" for segment_file in segment_files)
+        command = [FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file]
+        if audio_file:
+            command += ["-i", audio_file, "-map", "0:v", "-map", "1:a", "-c:a", "copy", "-shortest"]
+        command += ["-c:v", "copy", filename]
+        subprocess.run(command, check=True, capture_output=True)
+        return filename
+    finally:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+# WRITES ONE SCENE AS A STILL IMAGE (progress bar drawn at the scene's start)
+def write_scene_still(
+    scene: Scene, 
+    filename: str, 
+    total_duration: float, 
+    aspect_ratio: tuple[int, int] = ASPECT_RATIO
+) -> str:
+    frame = rasterize_scene(scene=scene, aspect_ratio=aspect_ratio).copy()
+    frame[0:PROGRESS_BAR_HEIGHT, :int(scene.start / total_duration * aspect_ratio[0])] = PROGRESS_BAR_COLOR
+    Image.fromarray(frame).save(filename, compress_level=1)
+    return filename
+
+# COUNTS ENCODED VIDEO FRAMES (one framecrc line per packet, nothing is decoded)
+def count_video_frames(filename: str) -> int:
+    result = subprocess.run(
+        [FFMPEG_BINARY, "-loglevel", "error", "-i", filename, "-map", "0:v", "-c", "copy", "-f", "framecrc", "-"],
+        check=True,
+        capture_output=True,
+        text=True
+    )
+    return sum(1 for line in result.stdout.splitlines() if line and not line.startswith("#"))
+
+# SNAPS SCENES TO THE FRAME GRID (scenes shorter than a tick give their time to the scene shown on that tick)
+def snap_scenes(scenes: list, fps: int = RENDER_FPS) -> list:
+    end_tick = max(round(scenes[-1].end * fps), 1)
+    shown = {}
+    for scene in scenes:
+        tick = min(round(scene.start * fps), end_tick - 1)
+        shown[tick] = scene
+    ticks = sorted(shown)
+    return [
+        Scene(
+            text=shown[tick].text,
+            duration=(next_tick - tick) / fps,
+            start=tick / fps,
+            photo=shown[tick].photo,
+            fontsize=shown[tick].fontsize,
+            style=shown[tick].style
+        )
+        for tick, next_tick in zip(ticks, ticks[1:] + [end_tick])
+    ]
+
+# ENCODES ONE FRAME PER SCENE CHANGE WITH VARIABLE FRAME RATE
+def render_stills(
+    scenes: list,
+    filename: str,
+    audio_file: str | None = None,
+    workers: int = RENDER_WORKERS,
+    fps: int = RENDER_FPS
+) -> str:
+
+    # Rasterizes scene stills in parallel
+    scenes = snap_scenes(scenes=scenes, fps=fps)
+    stills_dir = tempfile.mkdtemp(prefix="stills_", dir="/tmp")
+    try:
+        still_files = [os.path.join(stills_dir, f"scene_{i}.png") for i in range(len(scenes))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(
+                write_scene_still,
+                scenes,
+                still_files,
+                [scenes[-1].end] * len(scenes)
+            ))
+
+        # Lists each still for its scene duration (last entry repeated so its duration applies)
+        list_file = os.path.join(stills_dir, "scenes.ffconcat")
+        with open(list_file, "w") as stills:
+            stills.write("ffconcat version 1.0\n")
+            for scene, still_file in zip(scenes, still_files):
+                stills.write(f"file '{still_file}'\nduration {scene.duration:.6f}\n")
+            stills.write(f"file '{still_files[-1]}'\n")
+
+        # Encodes on a 1/fps timebase without duplicating frames
+        # (capped with -t, since -shortest drops trailing sparse frames when audio is muxed)
+        command = [FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file]
+        if audio_file:
+            command += ["-i", audio_file, "-map", "0:v", "-map", "1:a", "-c:a", "copy"]
+        command += STILL_ENCODER_SETTINGS + [
+            "-fps_mode", "vfr",
+            "-video_track_timescale", str(fps),
+            "-t", f"{scenes[-1].end:.6f}",
+            filename
+        ]
+        subprocess.run(command, check=True, capture_output=True)
+
+        # Every snapped scene must own a frame
+        expected = len(scenes)
+        encoded = count_video_frames(filename=filename)
+        if encoded != expected:
+            raise RuntimeError(f"ENCODED {encoded} FRAMES FOR {expected} SCENES")
+        return filename
+    finally:
+        shutil.rmtree(stills_dir, ignore_errors=True)
+
 # CREATES TEXT CLIP VIDEO
 def create_text_clip(
     text: str, 
     duration: float,
     total_duration: float,
+    start: float = 0,
     photo: ImageClip = "",
     fontsize: int = 150, 
     text_stroke_width: int = 10,
@@ -84,15 +353,7 @@ def create_text_clip(
 ) -> CompositeVideoClip:
 
     # Identifies font of clip
-    match style:
-        case 1:
-            font = "fonts/fragile-bombers.otf"
-        case 2:
-            font = "fonts/fragile-bombers-attack.otf"
-        case 3:
-            font = "fonts/fragile-bombers-down.otf"
-        case _:
-            font = "fonts/fragile-bombers.otf"
+    font = get_font(style=style)
 
     # Create a background color clip
     background_clip = ColorClip(
@@ -103,7 +364,8 @@ def create_text_clip(
     background_clip = add_progress_bar(
         clip=background_clip, 
         color=(255, 255, 255), 
-        total_duration=total_duration
+        total_duration=total_duration,
+        start=start
     )
 
     # Create a text clip
@@ -186,30 +448,27 @@ def create_script_beta(
         if len(audio_timestamps) > 0:
 
             total_duration = sum(audio_timestamps)
-            images = []
-            image_urls = []
-
-            # Gets photos for words
-            for word in words:
-                success, photo = model_helper.get_photo(query=word)
-                if success:
-                    images.append(photo[1])
-                    image_urls.append(photo[0])
-                else:
-                    images.append("not found")
+
+            # Gets photo paths for words (shared across scenes using the same query)
+            photos = model_helper.get_photos(words=words)
+            images = [
+                photos[query][1] if query in photos else "not found" 
+                for query in (model_helper.get_photo_query(word) for word in words)
+            ]
 
             return True, words, audio, audio_timestamps, images, total_duration
         else:
-            model_helper.log("ERROR WITH AUDIO TIMESTAMPS.")
+            model_helper.log("ERROR WITH AUDIO TIMESTAMPS.", level="error")
             return False, None, None, None, None, None
     else:
-        model_helper.log("ERROR WITH SCRIPT PROCESSING.")
+        model_helper.log("ERROR WITH SCRIPT PROCESSING.", level="error")
         return False, None, None, None, None, None
         
 # CREATES VIDEO
 def create_video_beta(
     text: str,
-    speed_factor: float = 1
+    speed_factor: float = 1,
+    fast: bool = True
 ):
     
     # Create script and find times
@@ -219,40 +478,63 @@ def create_video_beta(
 
     if success:
 
-        # Creates scenes
-        scenes = []
-        for word, audio_timestamp, image in zip(words, audio_timestamps, images):
-            if image == "not found":
-                scenes.append(
-                    create_text_clip(
-                        text=word,
-                        fontsize=random.randint(75, 175),
-                        duration=audio_timestamp,
-                        has_photo=False,
-                        photo=image,
-                        total_duration=total_duration
-                    )
+        # Renders to a file owned by this call (caller removes it after uploading)
+        output_file, filename = tempfile.mkstemp(prefix="output_", suffix=".mp4", dir="/tmp")
+        os.close(output_file)
+
+        # Creates scenes with absolute time ranges
+        scenes = create_scenes(
+            words=words,
+            durations=audio_timestamps,
+            images=images
+        )
+
+        # Renders pre-rasterized frames directly (speed changes need moviepy)
+        if fast and speed_factor == 1:
+            if VIDEO_ENCODING == "still":
+                return render_stills(
+                    scenes=scenes,
+                    filename=filename,
+                    audio_file=audio.filename
+                )
+            if VIDEO_ENCODING == "segmented" and RENDER_WORKERS > 1 and len(scenes) >= RENDER_WORKERS:
+                return render_segmented(
+                    scenes=scenes,
+                    filename=filename,
+                    audio_file=audio.filename
                 )
-            else:
-                scenes.append(
-                    create_text_clip(
-                        text=word,
-                        fontsize=random.randint(75, 175),
-                        duration=audio_timestamp,
-                        has_photo=True,
-                        photo=image,
-                        total_duration=total_duration
-                    )
+            return render_frames(
+                scenes=scenes,
+                filename=filename,
+                audio_file=audio.filename
+            )
+
+        # Creates clips
+        clips = []
+        photos = {}
+        for scene in scenes:
+            if scene.photo and scene.photo not in photos:
+                photos[scene.photo] = ImageClip(scene.photo)
+            clips.append(
+                create_text_clip(
+                    text=scene.text,
+                    fontsize=scene.fontsize,
+                    duration=scene.duration,
+                    has_photo=scene.photo != "",
+                    photo=photos.get(scene.photo, ""),
+                    total_duration=total_duration,
+                    start=scene.start
                 )
+            )
 
         # Renders final video
         return render_video(
-            clips=scenes,
-            filename="/tmp/output.mp4",
+            clips=clips,
+            filename=filename,
             speed_factor=speed_factor,
             with_audio=True,
             audio=audio
         )
     
     else:
-        model_helper.log("VIDEO CREATION FAILED")
\ No newline at end of file
+        model_helper.log("VIDEO CREATION FAILED", level="error")